@@ -1,18 +1,26 @@
 import os
 import requests
+import aiohttp
+import asyncio
 import csv
+from collections import Counter
 from datetime import datetime
 import time
 import random
 from sqlfuzzer import SqlFuzzer  # Import your fuzzer class
 
+SERVER_URL = 'http://server:5000/request'  # Adjust server URL as needed
+
+# Seconds the server has to answer in the load test
+REQUEST_TIMEOUT = 30
+
 # Function to wait until services are ready (if needed)
 def wait_until_services_ready():
     time.sleep(5)  # Adjust the delay as needed based on your Docker service startup time
 
 # Function to send request to server and return the results
 def send_request(payload):
-    url = 'http://server:5000/request'  # Adjust server URL as needed
+    url = SERVER_URL
     data = {
         'payload': payload.strip()  # Remove any trailing newline characters
     }
@@ -59,6 +67,179 @@ def determine_combined_result(original_status, waf_status, ml_status):
     else:
         return 'waf_incorrect_ml_correct'
 
+# Function to send request to server in the load test, also returning the
+# latencies in milliseconds of the whole request and of the WAF and ML paths
+async def send_request_async(session, payload):
+    data = {
+        'payload': payload.strip()
+    }
+    started = time.perf_counter()
+    try:
+        async with session.post(SERVER_URL, json=data) as response:
+            if response.status == 200:
+                body = await response.json()
+                waf_status_code = body.get('WAF_status_code', 'Unknown')
+                ml_status_code = body.get('ML_status_code', 'Unknown')
+            else:
+                await response.read()
+                body = {}
+                waf_status_code = response.status
+                ml_status_code = 'Error'
+        latency_ms = round((time.perf_counter() - started) * 1000, 3)
+
+        return waf_status_code, ml_status_code, latency_ms, \
+            body.get('WAF_latency_ms'), body.get('ML_latency_ms')
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"An error occurred: {e!r}")
+        return 'Error: Connection failed', 'Error: Connection failed', \
+            None, None, None
+
+# Function to parse TARGET_RPS: '20' is a constant rate, '5:50' ramps from 5
+# to 50 requests per second along the test and '0' sends them as fast as the
+# concurrency allows. A ramp can't start or end at 0, there's no schedule for it
+def parse_target_rps(value):
+    start, _, end = value.partition(':')
+    start = float(start or 0)
+    end = float(end) if end else start
+    if start < 0 or end < 0:
+        raise ValueError(f"TARGET_RPS can't be negative: {value}")
+    if (start == 0) != (end == 0):
+        raise ValueError(f"TARGET_RPS ramps must start and end above 0: {value}")
+    return start, end
+
+# Function to parse CONCURRENCY, the most requests waiting for their answers.
+# With less than 1 no request would ever be sent
+def parse_concurrency(value):
+    concurrency = int(value)
+    if concurrency < 1:
+        raise ValueError(f"CONCURRENCY must be at least 1: {value}")
+    return concurrency
+
+# Function to compute when each request is sent, in seconds from the start
+def request_schedule(count, start_rps, end_rps):
+    offsets = []
+    offset = 0.0
+    for i in range(count):
+        offsets.append(offset)
+        offset += 1 / (start_rps + (end_rps - start_rps) * i / max(count - 1, 1))
+    return offsets
+
+# Function to compute a percentile with the nearest rank method
+def percentile(values, p):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round((len(values) - 1) * p / 100)))]
+
+# Function to run the load test: every sampled payload and its fuzzed variants
+# are sent by up to `concurrency` concurrent requests, at the target rate.
+# The schedule is open loop while there's a free slot: once `concurrency`
+# requests wait for their answers, the next ones wait too and are sent late
+# (see the send lag), so at low concurrency the test is closed loop
+async def run_load_test(sample_payloads, num_fuzzing_rounds, concurrency, target_rps):
+    # Fuzzed before the clock starts
+    jobs = []
+    for row in sample_payloads:
+        original_payload, original_status = row[0], int(row[1])
+        jobs.append((original_payload, original_status))
+        fuzzer = SqlFuzzer(original_payload)
+        for _ in range(num_fuzzing_rounds):
+            jobs.append((fuzzer.fuzz(), original_status))
+
+    start_rps, end_rps = parse_target_rps(target_rps)
+    offsets = request_schedule(len(jobs), start_rps, end_rps) if start_rps > 0 else None
+
+    slots = asyncio.Semaphore(concurrency)
+    results = [None] * len(jobs)
+    lags = [0.0] * len(jobs)
+    loop = asyncio.get_event_loop()
+
+    async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency),
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) as session:
+        started = loop.time()
+
+        async def run(i, payload):
+            if offsets:
+                delay = started + offsets[i] - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            async with slots:
+                # How late the request is sent, waiting for a free slot
+                if offsets:
+                    lags[i] = round(max(loop.time() - started - offsets[i], 0) * 1000, 3)
+                results[i] = await send_request_async(session, payload)
+
+        await asyncio.gather(*[run(i, payload) for i, (payload, _) in enumerate(jobs)])
+        elapsed = loop.time() - started
+
+    counts = Counter()
+    with open('logs/client_load_logs.csv', mode='w', newline='') as log_file:
+        writer = csv.writer(log_file)
+        writer.writerow(['Sr NO.', 'Payload', 'Original Status', 'WAF Status', 'ML Status',
+                         'Combined Result', 'Latency (ms)', 'WAF Latency (ms)', 'ML Latency (ms)'])
+
+        for serial_number, ((payload, original_status), result) in enumerate(zip(jobs, results), start=1):
+            waf_status_code, ml_status_code, latency, waf_latency, ml_latency = result
+            counts['WAF ' + determine_metrics(original_status, waf_status_code)] += 1
+            counts['ML ' + determine_metrics(original_status, ml_status_code)] += 1
+            combined_result = determine_combined_result(original_status, waf_status_code, ml_status_code)
+            counts[combined_result] += 1
+            if latency is None or 'Error' in (waf_status_code, ml_status_code):
+                counts['errors'] += 1
+            writer.writerow([serial_number, payload, original_status, waf_status_code, ml_status_code,
+                             combined_result, latency, waf_latency, ml_latency])
+
+        latencies = [
+            ('Request', [r[2] for r in results]),
+            ('WAF', [r[3] for r in results]),
+            ('ML', [r[4] for r in results]),
+        ]
+        if offsets:
+            latencies.append(('Send lag', lags))
+
+        writer.writerow([])
+        writer.writerow(['Overall Results'])
+        for name in ('WAF TP', 'WAF TN', 'WAF FP', 'WAF FN', 'ML TP', 'ML TN', 'ML FP', 'ML FN'):
+            writer.writerow([name, counts[name]])
+
+        writer.writerow([])
+        writer.writerow(['Combined Results (2x2 Matrix)'])
+        writer.writerow(['', 'WAF Correct', 'WAF Incorrect'])
+        writer.writerow(['ML Correct', counts['both_correct'], counts['waf_incorrect_ml_correct']])
+        writer.writerow(['ML Incorrect', counts['waf_correct_ml_incorrect'], counts['both_incorrect']])
+
+        writer.writerow([])
+        writer.writerow(['Load Results'])
+        writer.writerow(['Requests', len(jobs)])
+        writer.writerow(['Errors', counts['errors']])
+        writer.writerow(['Seconds', round(elapsed, 3)])
+        writer.writerow(['Requests/s', round(len(jobs) / elapsed, 2)])
+        writer.writerow(['Latency (ms)', 'p50', 'p90', 'p99', 'max'])
+        for name, values in latencies:
+            writer.writerow([name] + [percentile(values, p) for p in (50, 90, 99, 100)])
+
+    target = f"{start_rps:g}" if start_rps == end_rps else f"{start_rps:g} to {end_rps:g}"
+    print(f"\nLoad Results: {len(jobs)} requests in {elapsed:.2f}s - "
+          f"{len(jobs) / elapsed:.2f} requests/s (target: {target if start_rps > 0 else 'max'}) - "
+          f"concurrency: {concurrency} - errors: {counts['errors']}")
+    print(f"{'Latency (ms)':<15}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for name, values in latencies:
+        print(f"{name:<15}" + "".join(
+            f"{v:>10.1f}" if v is not None else f"{'-':>10}"
+            for v in (percentile(values, p) for p in (50, 90, 99, 100))
+        ))
+
+    print("\nOverall Results:")
+    print("  ".join(f"{name}: {counts[name]}" for name in ('WAF TP', 'WAF TN', 'WAF FP', 'WAF FN')))
+    print("  ".join(f"{name}: {counts[name]}" for name in ('ML TP', 'ML TN', 'ML FP', 'ML FN')))
+
+    print("\nCombined Results (2x2 Matrix):")
+    print(f"{'':<15}{'WAF Correct':<15}{'WAF Incorrect':<15}")
+    print(f"{'ML Correct':<15}{counts['both_correct']:<15}{counts['waf_incorrect_ml_correct']:<15}")
+    print(f"{'ML Incorrect':<15}{counts['waf_correct_ml_incorrect']:<15}{counts['both_incorrect']:<15}")
+
 # Function to run the main process
 def main():
     wait_until_services_ready()  # Wait for services to start up
@@ -77,6 +258,17 @@ def main():
     # Select a random sample of payloads
     sample_payloads = random.sample(payloads, min(num_samples, len(payloads)))
 
+    # Load-generation mode, with several concurrent requests or a target rate
+    target_rps = os.getenv('TARGET_RPS', '0')
+    try:
+        concurrency = parse_concurrency(os.getenv('CONCURRENCY', '1'))
+        start_rps, _ = parse_target_rps(target_rps)
+    except ValueError as e:
+        raise SystemExit(e)
+    if concurrency > 1 or start_rps > 0:
+        asyncio.run(run_load_test(sample_payloads, num_fuzzing_rounds, concurrency, target_rps))
+        return
+
     with open('logs/client_logs.csv', mode='w', newline='') as log_file:
         writer = csv.writer(log_file)
         # Write the header row
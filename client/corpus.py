@@ -0,0 +1,178 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+from sqlfuzzer import SqlFuzzer
+
+# Variants generated by each task sent to the workers
+CHUNK_SIZE = 500
+
+# Seconds between progress reports
+REPORT_INTERVAL = 2.0
+
+# Function to read the seed payloads and their expected status codes
+def read_seeds(payloads_file):
+    with open(payloads_file, mode='r', newline='') as file:
+        reader = csv.reader(file)
+        next(reader)  # Skip the header row
+        return [(row[0], int(row[1])) for row in reader if row]
+
+# Each task fuzzes with its own RNG, seeded from the run seed and its index,
+# so the corpus is the same whatever the number of workers or the task order
+def task_seed(seed, index):
+    return f"{seed}:{index}"
+
+# Split the variants of every seed payload into tasks for the workers
+def make_tasks(seeds, variants, depth, seed, chunk_size=CHUNK_SIZE, weights=None):
+    tasks = []
+    for seed_index, (payload, status) in enumerate(seeds):
+        for start in range(0, variants, chunk_size):
+            count = min(chunk_size, variants - start)
+            tasks.append((task_seed(seed, len(tasks)), seed_index, payload, status, count, depth, weights))
+    return tasks
+
+# Worker: fuzz a seed payload `count` times. The fuzzer starts again from the
+# seed payload every `depth` rounds, so variants stack 1 to `depth` mutations
+def fuzz_task(task):
+    rng_seed, seed_index, payload, status, count, depth, weights = task
+    fuzzer = SqlFuzzer(payload, seed=rng_seed, weights=weights)
+    return seed_index, payload, status, fuzzer.fuzz_many(count, depth)
+
+def run_tasks(tasks, workers):
+    if workers <= 1:
+        for task in tasks:
+            yield fuzz_task(task)
+        return
+
+    with Pool(workers) as pool:
+        # In order, so the output file is the same on every run
+        yield from pool.imap(fuzz_task, tasks)
+
+# Key of a payload in the set of the ones already written, a digest to keep
+# the memory low on big corpora
+def dedup_key(payload):
+    return hashlib.blake2b(payload.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+def print_progress(generated, written, started, total):
+    elapsed = time.perf_counter() - started
+    duplicates = generated - written
+    print(f"{generated}/{total} variants - {written} written - "
+          f"{duplicates} duplicates ({duplicates / max(generated, 1):.1%}) - "
+          f"{generated / elapsed:.0f} variants/s", file=sys.stderr)
+
+# Function to generate the corpus: `variants` fuzzed variants of each seed
+# payload, written as JSON lines without duplicates
+def generate_corpus(payloads_file, output_file, variants, depth=5, workers=None, seed=0, chunk_size=CHUNK_SIZE,
+                    weights=None):
+    seeds = read_seeds(payloads_file)
+    tasks = make_tasks(seeds, variants, depth, seed, chunk_size, weights)
+    total = variants * len(seeds)
+    workers = workers or os.cpu_count() or 1
+
+    # The seed payloads themselves aren't variants
+    seen = {dedup_key(payload) for payload, _ in seeds}
+
+    started = time.perf_counter()
+    last_report = started
+    generated = written = 0
+
+    with open(output_file, mode='w', encoding='utf-8') as file:
+        for seed_index, payload, status, fuzzed in run_tasks(tasks, workers):
+            lines = []
+            for variant in fuzzed:
+                key = dedup_key(variant)
+                if key in seen:
+                    continue
+                seen.add(key)
+                lines.append(json.dumps({
+                    'payload': variant,
+                    'status_code': status,
+                    'seed': seed_index,
+                    'seed_payload': payload
+                }) + '\n')
+
+            file.writelines(lines)
+            generated += len(fuzzed)
+            written += len(lines)
+
+            now = time.perf_counter()
+            if now - last_report >= REPORT_INTERVAL:
+                print_progress(generated, written, started, total)
+                last_report = now
+
+    elapsed = time.perf_counter() - started
+    print_progress(generated, written, started, total)
+
+    return {
+        'seeds': len(seeds),
+        'generated': generated,
+        'written': written,
+        'duplicates': generated - written,
+        'workers': workers,
+        'seconds': round(elapsed, 3),
+        'variants_per_second': round(generated / elapsed, 1)
+    }
+
+# Parse the strategy weights, i.e: "swap_keywords=3,random_case=0"
+def parse_weights(value):
+    weights = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        try:
+            weights[name.strip()] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid strategy weight: {item}")
+    return weights
+
+def argument_parser():
+    parser = argparse.ArgumentParser(
+        description='Generate a corpus of fuzzed variants of the payloads, '
+                    'as JSON lines, for offline scoring'
+    )
+    parser.add_argument('-p', '--payloads', default='payloads.csv',
+                        help="CSV file with the seed payloads and their status codes. Default: payloads.csv")
+    parser.add_argument('-o', '--output', default='logs/corpus.jsonl',
+                        help="JSON lines file to write. Default: logs/corpus.jsonl")
+    parser.add_argument('-n', '--variants', type=int, default=1000,
+                        help="variants generated from each seed payload, before removing duplicates. Default: 1000")
+    parser.add_argument('-d', '--depth', type=int, default=5,
+                        help="max fuzzing rounds stacked on a variant. Default: 5")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="worker processes, 1 runs them in this process. Default: number of CPUs")
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help="seed of the run, the same seed gives the same corpus. Default: 0")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help=f"variants generated by each task. Default: {CHUNK_SIZE}")
+    parser.add_argument('--weights', type=parse_weights, default=None,
+                        help="draw the strategies of each round by weight instead of running each one once, "
+                             "i.e: swap_keywords=3,random_case=0. Missing strategies weigh 1")
+    return parser
+
+def main():
+    args = argument_parser().parse_args()
+    if args.variants < 1 or args.depth < 1 or args.chunk_size < 1:
+        raise SystemExit("--variants, --depth and --chunk-size must be positive")
+
+    # Check the weights before starting the workers
+    try:
+        SqlFuzzer('', weights=args.weights)
+    except ValueError as e:
+        raise SystemExit(f"--weights: {e}")
+
+    output_directory = os.path.dirname(args.output)
+    if output_directory and not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    summary = generate_corpus(args.payloads, args.output, args.variants, args.depth,
+                              args.workers, args.seed, args.chunk_size, args.weights)
+
+    print(f"\nCorpus written to {args.output}")
+    for name, value in summary.items():
+        print(f"{name}: {value}")
+
+if __name__ == "__main__":
+    main()
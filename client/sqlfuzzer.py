@@ -1,230 +1,383 @@
 import random
 import re
+import string
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
 import sqlparse
-from wafamole.payloadfuzzer.fuzz_utils import (
-    replace_random,
-    filter_candidates,
-    random_string,
-    num_tautology,
-    string_tautology,
-    num_contradiction,
-    string_contradiction,
-)
+from sqlparse.lexer import tokenize as sql_tokenize
 
+# Patterns and symbol tables of the strategies, compiled once at import
 
-def reset_inline_comments(payload: str):
+INLINE_COMMENT = re.compile(r"/\*[^(/\*|\*/)]*\*/")
+
+NUMBER = re.compile(r"\b\d+\b")
+
+TAUTOLOGIES = [
+    re.compile(pattern) for pattern in (
+        r"\b(\d+)\b",
+        r"\b(\d+)(\s*=\s*|\s+(?i:like)\s+)\1\b",
+        r'(\'|\")([a-zA-Z]{1}[\w#@$]*)\1(\s*=\s*|\s+(?i:like)\s+)(\'|\")\2\4',
+        r'(\'|\")([a-zA-Z]{1}[\w#@$]*)\1(\s*(!=|<>)\s*|\s+(?i:not like)\s+)(\'|\")(?!\2)([a-zA-Z]{1}[\w#@$]*)\5',
+    )
+]
+
+INVARIANTS = [
+    " AND 1",  # Example of modification
+    " OR 0",   # Another example of modification
+    "(SELECT 1)",  # Yet another example
+]
+
+SPACES_TO_COMMENTS = {" ": ["/**/"], "/**/": [" "]}
+
+WHITESPACE_ALTERNATIVES = {
+    " ": ["\t", "\n"],
+    "\t": [" ", "\n"],
+    "\n": ["\t", " "],
+   # "\f": ["\t", "\n"]
+    #"\v": ["\t", "\n", "\f", " "],
+   # "\xa0": ["\t", "\n", "\f", "\v", " "],
+}
+
+SYMBOL_PATTERNS = {
+    symbol: re.compile(re.escape(symbol))
+    for symbol in list(SPACES_TO_COMMENTS) + list(WHITESPACE_ALTERNATIVES)
+}
+
+# Characters of the random strings, as wafamole draws them
+RANDOM_CHARS = string.digits + string.ascii_letters + string.punctuation
+
+TAUTOLOGY_CHARS = string.ascii_letters + string.digits
+
+SQL_KEYWORDS = frozenset(sqlparse.keywords.KEYWORDS_COMMON)
+
+KEYWORD_REPLACEMENTS = {
+    "||": [" OR ", " or "],
+    "OR": ["||", "or"],
+    "&&": [" AND ", " and "],
+    "AND": ["&&", "and"],
+    "<>": ["!=", " NOT LIKE ", " not like "],
+    "!=": ["<>", " NOT LIKE ", " not like "],
+    "NOT LIKE": ["not like"],
+    "=": [" LIKE ", " like "],
+    "LIKE": ["like"],
+}
+
+
+def random_string(rng=random, max_length: int = 5, spaces: bool = True):
     """
-    Removes a randomly chosen multi-line comment.
+    Random string of 1 to max_length characters.
 
     Arguments:
-        payload: query payload (string)
+        rng: random number generator
+        max_length: max length of the string (int)
+        spaces: whether it may contain whitespace (bool)
 
     Returns:
-        str: payload modified
+        str: random string
     """
-    positions = list(re.finditer(r"/\*[^(/\*|\*/)]*\*/", payload))
+    chars = RANDOM_CHARS + string.whitespace if spaces else RANDOM_CHARS
+    return "".join(rng.choice(chars) for _ in range(rng.randint(1, max_length)))
 
-    if not positions:
-        return payload
 
-    pos = random.choice(positions).span()
+def num_tautology(rng=random):
+    """
+    Random numeric tautology, like 42=42.
 
-    replacement = "/**/"
+    Arguments:
+        rng: random number generator
 
-    new_payload = payload[: pos[0]] + replacement + payload[pos[1] :]
+    Returns:
+        str: tautology
+    """
+    value = rng.randint(1, 10000)
+    return rng.choice(["{}={}", "{} LIKE {}"]).format(value, value)
 
-    return new_payload
 
+def string_tautology(rng=random):
+    """
+    Random string tautology, like 'a'='a'.
 
-def logical_invariant(payload: str):
+    Arguments:
+        rng: random number generator
+
+    Returns:
+        str: tautology
     """
-    Adds a logical invariant condition to the payload.
+    value = "".join(rng.choice(TAUTOLOGY_CHARS) for _ in range(rng.randint(1, 5)))
+    return rng.choice(["'{0}'='{0}'", "'{0}' LIKE '{0}'", '"{0}"="{0}"', '"{0}" LIKE "{0}"']).format(value)
+
+
+def tokenize(payload: str):
+    """
+    Splits a payload into the values of its SQL tokens, with the sqlparse
+    lexer. Joining them gives the payload back.
 
     Arguments:
         payload: query payload (string)
 
     Returns:
-        str: payload modified
+        list: token values (strings)
     """
-    num_tautologies = [r"\b(\d+)\b", r"\b(\d+)(\s*=\s*|\s+(?i:like)\s+)\1\b"]
-    string_tautologies = [
-        r'(\'|\")([a-zA-Z]{1}[\w#@$]*)\1(\s*=\s*|\s+(?i:like)\s+)(\'|\")\2\4',
-        r'(\'|\")([a-zA-Z]{1}[\w#@$]*)\1(\s*(!=|<>)\s*|\s+(?i:not like)\s+)(\'|\")(?!\2)([a-zA-Z]{1}[\w#@$]*)\5',
-    ]
+    try:
+        return [value for _, value in sql_tokenize(payload)]
+    except Exception:
+        return [payload]
+
+
+def render(tokens: list):
+    """
+    Joins the tokens back into a payload.
+
+    Arguments:
+        tokens: token values (list of strings)
+
+    Returns:
+        str: payload
+    """
+    return "".join(tokens)
+
+
+def splice(tokens: list, start: int, end: int, replacement: str):
+    """
+    Replaces the characters start:end of the payload with the replacement,
+    in place. Only the tokens overlapping them are tokenized again.
+
+    Arguments:
+        tokens: token values (list of strings)
+        start: first character replaced
+        end: character after the last one replaced
+        replacement: text inserted (string)
+    """
+    if not tokens:
+        tokens[:] = tokenize(replacement)
+        return
+
+    ends = list(accumulate(len(token) for token in tokens))
+    first = min(bisect_right(ends, start), len(tokens) - 1)
+    last = min(max(first, bisect_left(ends, end)), len(tokens) - 1)
+
+    offset = ends[first] - len(tokens[first])
+    text = render(tokens[first: last + 1])
+
+    tokens[first: last + 1] = tokenize(
+        text[: start - offset] + replacement + text[end - offset:]
+    )
+
+
+def replace_match(tokens: list, matches: list, replacement: str, rng=random):
+    """
+    Replaces a randomly chosen match with the replacement, in place.
+
+    Arguments:
+        tokens: token values (list of strings)
+        matches: matches over the rendered payload (list of re.Match)
+        replacement: text inserted (string)
+        rng: random number generator
+    """
+    start, end = rng.choice(matches).span()
+    splice(tokens, start, end, replacement)
+
+
+def replace_random(tokens: list, pattern, replacement: str, rng=random):
+    """
+    Replaces a randomly chosen match of the pattern with the replacement, in
+    place.
+
+    Arguments:
+        tokens: token values (list of strings)
+        pattern: compiled regular expression
+        replacement: text inserted (string)
+        rng: random number generator
+    """
+    matches = list(pattern.finditer(render(tokens)))
+    if matches:
+        replace_match(tokens, matches, replacement, rng)
+
+
+def reset_inline_comments(tokens: list, rng=random):
+    """
+    Removes a randomly chosen multi-line comment.
+
+    Arguments:
+        tokens: tokens of the query payload (list of strings)
+        rng: random number generator
+
+    Returns:
+        list: tokens modified in place
+    """
+    replace_random(tokens, INLINE_COMMENT, "/**/", rng)
+
+    return tokens
 
-    candidates = num_tautologies + string_tautologies
 
-    for pattern in candidates:
-        matches = list(re.finditer(pattern, payload))
+def logical_invariant(tokens: list, rng=random):
+    """
+    Adds a logical invariant condition to the payload.
+
+    Arguments:
+        tokens: tokens of the query payload (list of strings)
+        rng: random number generator
+
+    Returns:
+        list: tokens modified in place
+    """
+    payload = render(tokens)
+
+    for pattern in TAUTOLOGIES:
+        matches = list(pattern.finditer(payload))
         if matches:
-            match = random.choice(matches)
-            pos = match.span()
-            replacement = random.choice([
-                " AND 1",  # Example of modification
-                " OR 0",   # Another example of modification
-                "(SELECT 1)",  # Yet another example
-            ])
-            new_payload = payload[: pos[0]] + replacement + payload[pos[1] :]
-            return new_payload
+            start, end = rng.choice(matches).span()
+            splice(tokens, start, end, rng.choice(INVARIANTS))
+            break
 
-    return payload
+    return tokens
 
 
-def change_tautologies(payload: str):
+def change_tautologies(tokens: list, rng=random):
     """
     Replaces a randomly chosen numeric/string tautology with another one.
 
     Arguments:
-        payload: query payload (string)
+        tokens: tokens of the query payload (list of strings)
+        rng: random number generator
 
     Returns:
-        str: payload modified
+        list: tokens modified in place
     """
-    num_tautologies = [r'\b(\d+)\b', r'\b(\d+)(\s*=\s*|\s+(?i:like)\s+)\1\b']
-    string_tautologies = [
-        r'(\'|\")([a-zA-Z]{1}[\w#@$]*)\1(\s*=\s*|\s+(?i:like)\s+)(\'|\")\2\4',
-        r'(\'|\")([a-zA-Z]{1}[\w#@$]*)\1(\s*(!=|<>)\s*|\s+(?i:not like)\s+)(\'|\")(?!\2)([a-zA-Z]{1}[\w#@$]*)\5',
-    ]
+    payload = render(tokens)
 
-    candidates = num_tautologies + string_tautologies
-
-    for pattern in candidates:
-        matches = list(re.finditer(pattern, payload))
+    for pattern in TAUTOLOGIES:
+        matches = list(pattern.finditer(payload))
         if matches:
-            match = random.choice(matches)
-            pos = match.span()
-            replacement = random.choice([
-                num_tautology(),  # Replace with a numeric tautology
-                string_tautology(),  # Replace with a string tautology
+            start, end = rng.choice(matches).span()
+            replacement = rng.choice([
+                num_tautology(rng),  # Replace with a numeric tautology
+                string_tautology(rng),  # Replace with a string tautology
             ])
-            new_payload = payload[: pos[0]] + replacement + payload[pos[1] :]
-            return new_payload
+            splice(tokens, start, end, replacement)
+            break
 
-    return payload
+    return tokens
 
 
-def spaces_to_comments(payload: str):
+def replace_symbol(tokens: list, symbols: dict, rng=random):
     """
-    Replaces a randomly chosen space character with a multi-line comment (and vice-versa).
+    Replaces a randomly chosen occurrence of one of the symbols in the
+    payload with one of its replacements.
 
     Arguments:
-        payload: query payload (string)
+        tokens: tokens of the query payload (list of strings)
+        symbols: replacements of each symbol (dict)
+        rng: random number generator
 
     Returns:
-        str: payload modified
+        list: tokens modified in place
     """
-    symbols = {" ": ["/**/"], "/**/": [" "]}
+    payload = render(tokens)
 
-    symbols_in_payload = filter_candidates(symbols, payload)
+    symbols_in_payload = [s for s in symbols if s in payload]
 
     if not symbols_in_payload:
-        return payload
+        return tokens
 
-    candidate_symbol = random.choice(symbols_in_payload)
+    candidate_symbol = rng.choice(symbols_in_payload)
     replacements = symbols[candidate_symbol]
-    candidate_replacement = random.choice(replacements)
+    candidate_replacement = rng.choice(replacements)
+
+    replace_match(tokens,
+                  list(SYMBOL_PATTERNS[candidate_symbol].finditer(payload)),
+                  candidate_replacement,
+                  rng)
 
-    return replace_random(payload, re.escape(candidate_symbol), candidate_replacement)
+    return tokens
 
 
-def spaces_to_whitespaces_alternatives(payload: str):
+def spaces_to_comments(tokens: list, rng=random):
     """
-    Replaces a randomly chosen whitespace character with another one.
+    Replaces a randomly chosen space character with a multi-line comment (and vice-versa).
 
     Arguments:
-        payload: query payload (string)
+        tokens: tokens of the query payload (list of strings)
+        rng: random number generator
 
     Returns:
-        str: payload modified
+        list: tokens modified in place
     """
-    symbols = {
-        " ": ["\t", "\n"],
-        "\t": [" ", "\n"],
-        "\n": ["\t", " "],
-       # "\f": ["\t", "\n"]
-        #"\v": ["\t", "\n", "\f", " "],
-       # "\xa0": ["\t", "\n", "\f", "\v", " "],
-    }
+    return replace_symbol(tokens, SPACES_TO_COMMENTS, rng)
 
-    symbols_in_payload = filter_candidates(symbols, payload)
 
-    if not symbols_in_payload:
-        return payload
+def spaces_to_whitespaces_alternatives(tokens: list, rng=random):
+    """
+    Replaces a randomly chosen whitespace character with another one.
 
-    candidate_symbol = random.choice(symbols_in_payload)
-    replacements = symbols[candidate_symbol]
-    candidate_replacement = random.choice(replacements)
+    Arguments:
+        tokens: tokens of the query payload (list of strings)
+        rng: random number generator
 
-    return replace_random(payload, re.escape(candidate_symbol), candidate_replacement)
+    Returns:
+        list: tokens modified in place
+    """
+    return replace_symbol(tokens, WHITESPACE_ALTERNATIVES, rng)
 
 
-def random_case(payload: str):
+def random_case(tokens: list, rng=random):
     """
     Randomly changes the capitalization of the SQL keywords in the input payload.
 
     Arguments:
-        payload: query payload (string)
+        tokens: tokens of the query payload (list of strings)
+        rng: random number generator
 
     Returns:
-        str: payload modified
+        list: tokens modified in place
     """
-    tokens = []
-    try:
-        parsed_payload = sqlparse.parse(payload)
-    except Exception:
-        return payload
-    for t in parsed_payload:
-        tokens.extend(list(t.flatten()))
-
-    sql_keywords = set(sqlparse.keywords.KEYWORDS_COMMON.keys())
+    for idx, token in enumerate(tokens):
+        if token.upper() in SQL_KEYWORDS:
+            tokens[idx] = ''.join([c.swapcase() if rng.random() > 0.5 else c for c in token])
 
-    new_payload = []
-    for token in tokens:
-        if token.value.upper() in sql_keywords:
-            new_token = ''.join([c.swapcase() if random.random() > 0.5 else c for c in token.value])
-            new_payload.append(new_token)
-        else:
-            new_payload.append(token.value)
+    return tokens
 
-    return "".join(new_payload)
 
-
-def comment_rewriting(payload: str):
+def comment_rewriting(tokens: list, rng=random):
     """
     Changes the content of a randomly chosen in-line or multi-line comment.
 
     Arguments:
-        payload: query payload (string)
+        tokens: tokens of the query payload (list of strings)
+        rng: random number generator
 
     Returns:
-        str: payload modified
+        list: tokens modified in place
     """
-    p = random.random()
+    p = rng.random()
+    payload = render(tokens)
 
     if p < 0.5 and ("#" in payload or "-- " in payload):
-        return payload + random_string(2)
-    elif p >= 0.5 and re.search(r"/\*[^(/\*|\*/)]*\*/", payload):
-        return replace_random(payload, r"/\*[^(/\*|\*/)]*\*/", "/*" + random_string() + "*/")
-    else:
-        return payload
+        splice(tokens, len(payload), len(payload), random_string(rng, 2))
+    elif p >= 0.5:
+        replace_random(tokens, INLINE_COMMENT, "/*" + random_string(rng) + "*/", rng)
 
+    return tokens
 
-def swap_int_repr(payload: str):
+
+def swap_int_repr(tokens: list, rng=random):
     """
     Changes the representation of a randomly chosen numerical constant with an equivalent one.
 
     Arguments:
-        payload: query payload (string)
+        tokens: tokens of the query payload (list of strings)
+        rng: random number generator
 
     Returns:
-        str: payload modified
+        list: tokens modified in place
     """
-    candidates = list(re.finditer(r'\b\d+\b', payload))
+    payload = render(tokens)
+    candidates = list(NUMBER.finditer(payload))
 
     if not candidates:
-        return payload
+        return tokens
 
-    candidate_pos = random.choice(candidates).span()
+    candidate_pos = rng.choice(candidates).span()
 
     candidate = payload[candidate_pos[0]: candidate_pos[1]]
 
@@ -233,55 +386,46 @@ def swap_int_repr(payload: str):
         "(SELECT {})".format(candidate),
     ]
 
-    replacement = random.choice(replacements)
+    replacement = rng.choice(replacements)
 
-    return payload[: candidate_pos[0]] + replacement + payload[candidate_pos[1]:]
+    splice(tokens, candidate_pos[0], candidate_pos[1], replacement)
 
+    return tokens
 
-def swap_keywords(payload: str):
+
+def swap_keywords(tokens: list, rng=random):
     """
     Replaces a randomly chosen SQL operator with a semantically equivalent one.
 
     Arguments:
-        payload: query payload (string)
+        tokens: tokens of the query payload (list of strings)
+        rng: random number generator
 
     Returns:
-        str: payload modified
-    """
-    replacements = {
-        "||": [" OR ", " or "],
-        "OR": ["||", "or"],
-        "&&": [" AND ", " and "],
-        "AND": ["&&", "and"],
-        "<>": ["!=", " NOT LIKE ", " not like "],
-        "!=": ["<>", " NOT LIKE ", " not like "],
-        "NOT LIKE": ["not like"],
-        "=": [" LIKE ", " like "],
-        "LIKE": ["like"],
-    }
-
-    tokens = []
-    try:
-        parsed_payload = sqlparse.parse(payload)
-    except Exception:
-        return payload
-    for t in parsed_payload:
-        tokens.extend(list(t.flatten()))
-
-    indices = [idx for idx, token in enumerate(tokens) if token.value in replacements]
+        list: tokens modified in place
+    """
+    indices = [idx for idx, token in enumerate(tokens) if token in KEYWORD_REPLACEMENTS]
     if not indices:
-        return payload
+        return tokens
 
-    target_idx = random.choice(indices)
-    new_payload = "".join([
-        random.choice(replacements[token.value]) if idx == target_idx else token.value for idx, token in enumerate(tokens)
-    ])
+    target_idx = rng.choice(indices)
+    tokens[target_idx: target_idx + 1] = tokenize(rng.choice(KEYWORD_REPLACEMENTS[tokens[target_idx]]))
 
-    return new_payload
+    return tokens
 
 
 class SqlFuzzer(object):
-    """SqlFuzzer class"""
+    """
+    SqlFuzzer class
+
+    Each fuzzer owns its random number generator, seeded with `seed`, and
+    its order of the strategies, so fuzzers can run in several threads or
+    tasks and the same seed gives the same variants.
+
+    By default each round applies every strategy once, in a random order.
+    With `weights`, strategy names to weights (1 when missing, 0 disables
+    one), each round applies `rounds` strategies drawn by weight instead.
+    """
 
     strategies = [
         reset_inline_comments,
@@ -295,19 +439,66 @@ class SqlFuzzer(object):
         swap_keywords,
     ]
 
-    def __init__(self, payload):
+    def __init__(self, payload, seed=None, weights=None, rounds=None):
         self.initial_payload = payload
         self.payload = payload
 
+        self.rng = random.Random(seed)
+        self.strategies = list(SqlFuzzer.strategies)
+        self.rounds = rounds or len(self.strategies)
+
+        self.cum_weights = None
+        if weights is not None:
+            names = {strategy.__name__ for strategy in self.strategies}
+            unknown = sorted(set(weights) - names)
+            if unknown:
+                raise ValueError(f"Unknown strategies: {', '.join(unknown)}")
+
+            negative = sorted(name for name, weight in weights.items() if weight < 0)
+            if negative:
+                raise ValueError(f"Negative weights: {', '.join(negative)}")
+
+            self.cum_weights = list(accumulate(
+                weights.get(strategy.__name__, 1) for strategy in self.strategies
+            ))
+            if self.cum_weights[-1] <= 0:
+                raise ValueError("At least a strategy needs a positive weight")
+
+        # The payload is tokenized once, the strategies mutate the tokens
+        # and the payload is only rendered after the last one
+        self.initial_tokens = tokenize(payload)
+        self.tokens = list(self.initial_tokens)
+
+    def schedule(self):
+        if self.cum_weights is None:
+            self.rng.shuffle(self.strategies)  # Shuffle to ensure each strategy runs exactly once
+            return self.strategies
+
+        return self.rng.choices(self.strategies, cum_weights=self.cum_weights, k=self.rounds)
+
     def fuzz(self):
-        random.shuffle(self.strategies)  # Shuffle to ensure each strategy runs exactly once
-        for strategy in self.strategies:
-            self.payload = strategy(self.payload)
+        for strategy in self.schedule():
+            strategy(self.tokens, self.rng)
+        self.payload = render(self.tokens)
         return self.payload
 
+    def fuzz_many(self, n, depth=None):
+        """
+        Returns n variants. Each one is fuzzed from the previous one, as
+        calling fuzz() n times, or with `depth` from the initial payload
+        again every `depth` variants.
+        """
+        variants = []
+        for i in range(n):
+            if depth and i % depth == 0:
+                self.reset()
+            variants.append(self.fuzz())
+        return variants
+
     def current(self):
         return self.payload
 
     def reset(self):
         self.payload = self.initial_payload
-        return self.payload
\ No newline at end of file
+        self.tokens = list(self.initial_tokens)
+        return self.payload
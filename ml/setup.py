@@ -24,7 +24,8 @@ setup(
     description='WAF-brain: the clever and efficient Firewall for the Web',
     entry_points={'console_scripts': [
         'waf-brain = waf_brain.__main__:serve',
-        'waf-models = waf_brain.__main__:list_models',
+        'waf-models = waf_brain.__main__:models',
+        'waf-brain-bench = waf_brain.__main__:bench',
     ]},
     classifiers=[
         'Environment :: Console',
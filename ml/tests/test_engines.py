@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from waf_brain.data import model_path
+from waf_brain.engines import KerasEngine, NumPyEngine
+from waf_brain.inferring import (
+    encode_payload, window_indices, model_features, score_payloads
+)
+
+keras_models = pytest.importorskip("keras.models")
+
+PAYLOADS = [
+    "c/ la hoz, 17",
+    "-3520%' or 8571=8571--",
+    "1 UNION SELECT username, password FROM users/*x*/",
+    "a",
+    "",
+]
+
+# Every shipped model
+MODELS = (
+    "model_feat-3_botneck-20",
+    "model_feat-3_botneck-40",
+    "model_feat-5_botneck-101",
+    "model_feat-5_botneck-101_v2",
+    "model_feat-7_botneck-101",
+    "model_feat-11_botneck-101",
+)
+
+
+@pytest.fixture(scope="module", params=MODELS)
+def engines(request):
+    path = model_path(request.param)
+
+    return (KerasEngine(keras_models.load_model(path)),
+            NumPyEngine.from_h5(path))
+
+
+def test_predictions_match_keras(engines):
+    keras_engine, numpy_engine = engines
+    windows = np.concatenate([
+        window_indices(encode_payload(payload),
+                       model_features(numpy_engine))[0]
+        for payload in PAYLOADS
+    ])
+
+    keras_logits, keras_predictions = keras_engine.predict_logits(windows)
+    numpy_logits, numpy_predictions = numpy_engine.predict_logits(windows)
+
+    np.testing.assert_allclose(numpy_logits, keras_logits, atol=1e-4)
+    np.testing.assert_allclose(numpy_predictions, keras_predictions,
+                               atol=1e-5)
+
+
+def test_scores_match_keras(engines):
+    keras_engine, numpy_engine = engines
+
+    assert score_payloads(numpy_engine, PAYLOADS) == pytest.approx(
+        score_payloads(keras_engine, PAYLOADS), abs=1e-6
+    )
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from waf_brain.engines import NumPyEngine
+from waf_brain.data import model_path
+from waf_brain.inferring import (
+    VOCABULARY, PAD_INDEX, ONE_HOT_SIZE, encode_payload, window_indices,
+    one_hot_windows, featurize, score_payload, score_payloads
+)
+
+PAYLOADS = [
+    "c/ la hoz, 17",
+    "-3520%' or 8571=8571--",
+    "1 UNION SELECT username, password FROM users/*x*/",
+    "a",
+    "\t\n '\"\\",
+]
+
+X_FEATURES = (1, 3, 5, 7, 11)
+
+
+def loop_windows(payload: str, x_features: int):
+    """
+    Windows and targets built as the featurizer did before it was
+    vectorized, a character at a time.
+    """
+    row = [VOCABULARY.index(char) for char in payload]
+    past_pos = x_features - 1
+
+    windows, targets = [], []
+    for index, char in enumerate(row):
+        new_row = [None] * (x_features + 1)
+
+        if index > past_pos:
+            for i in range(-past_pos, 0):
+                new_row[past_pos + i] = row[index + i]
+        else:
+            for i in range(x_features, 0, -1):
+                if index - i >= 0:
+                    x = index - i + 1
+                    new_row[past_pos - x] = row[index - x]
+
+        new_row[past_pos] = char
+        if index + 1 < len(row):
+            new_row[-1] = row[index + 1]
+
+        new_row = [PAD_INDEX if i is None else i for i in new_row]
+        windows.append(new_row[:-1])
+        targets.append(new_row[-1])
+
+    return windows, targets
+
+
+def loop_one_hot(windows: list) -> np.ndarray:
+    x = np.zeros((len(windows), len(windows[0]), ONE_HOT_SIZE))
+    for i, window in enumerate(windows):
+        for j, index in enumerate(window):
+            x[i][j][index] = 1
+
+    return x
+
+
+@pytest.fixture(scope="module")
+def model():
+    return NumPyEngine.from_h5(model_path("model_feat-5_botneck-101"))
+
+
+@pytest.mark.parametrize("x_features", X_FEATURES)
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_windows_match_loop(payload, x_features):
+    windows, targets = window_indices(encode_payload(payload), x_features)
+    expected_windows, expected_targets = loop_windows(payload, x_features)
+
+    assert windows.tolist() == expected_windows
+    assert targets.tolist() == expected_targets
+    assert np.array_equal(one_hot_windows(windows, dtype=np.float64),
+                          loop_one_hot(expected_windows))
+
+
+@pytest.mark.parametrize("x_features", X_FEATURES)
+def test_empty_payload_has_no_windows(x_features):
+    windows, targets = window_indices(encode_payload(""), x_features)
+
+    assert windows.shape == (0, x_features)
+    assert targets.shape == (0, )
+
+
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_featurize_matches_loop(payload):
+    x, y = featurize(payload)
+    expected_windows, expected_targets = loop_windows(payload, 5)
+
+    assert np.array_equal(x, loop_one_hot(expected_windows))
+    assert y.tolist() == [
+        [float(i == target) for i in range(ONE_HOT_SIZE)]
+        for target in expected_targets
+    ]
+
+
+def test_out_of_vocabulary():
+    with pytest.raises(ValueError):
+        encode_payload("café")
+
+
+def test_batched_scores_match_single(model):
+    payloads = PAYLOADS + [""]
+
+    assert score_payloads(model, payloads) == [
+        score_payload(model, payload)[0] for payload in payloads
+    ]
@@ -1,12 +1,21 @@
 import logging
 import argparse
 import os
+import json
 
-from waf_brain.data import WAFBrainRunningConfig
+from waf_brain.bundles import compile_bundle, benchmark_loading
+from waf_brain.data import WAFBrainRunningConfig, model_path
+from waf_brain.engines import ENGINES, BUCKET_SCHEMES
 from waf_brain.helpers import get_log_level
+from waf_brain.service.dumping import DUMP_FORMATS
 
 log = logging.getLogger("waf-brain")
 
+# Payloads the client replays, in a checkout of the repository
+DEFAULT_PAYLOADS = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), "..", "..", "client", "payloads.csv"
+))
+
 
 def argument_parser():
     parser = argparse.ArgumentParser(
@@ -19,6 +28,13 @@ def argument_parser():
         help='log level',
         default=3
     )
+    parser.add_argument(
+        '--debug-sample-rate',
+        help="fraction of the requests logged at debug level (-vvvv). "
+             "Default: 0.01",
+        type=float,
+        default=0.01
+    )
 
     # -------------------------------------------------------------------------
     # Parser: serve
@@ -48,6 +64,67 @@ def argument_parser():
         '-b', '--backlog', help='maximum concurrent connections',
         default=512
     )
+    server.add_argument(
+        '-w', '--workers',
+        help="worker processes. Each one loads the model, use "
+             "'--engine numpy' with a compiled model to share its weights. "
+             "Default: 1",
+        type=int,
+        default=1
+    )
+    server.add_argument(
+        '--admin-token',
+        help="token of the admin endpoints (POST /__reload, /__stats), "
+             "sent as 'Authorization: Bearer <token>'. Without it, they are "
+             "only allowed from localhost",
+        default=None
+    )
+    server.add_argument(
+        '--metrics-path',
+        help="path of the Prometheus metrics. Default: /metrics",
+        default="/metrics"
+    )
+    server.add_argument(
+        '--upstream-pool-size',
+        help="max connections to the protected service. Default: 100",
+        type=int,
+        default=100
+    )
+    server.add_argument(
+        '--upstream-per-host',
+        help="max connections to each host of the protected service. "
+             "Default: 0 (no limit)",
+        type=int,
+        default=0
+    )
+    server.add_argument(
+        '--upstream-keepalive',
+        help="seconds an idle connection to the protected service is kept. "
+             "Default: 15",
+        type=float,
+        default=15
+    )
+    server.add_argument(
+        '--upstream-dns-ttl',
+        help="seconds the protected service DNS resolution is cached. "
+             "Default: 10",
+        type=int,
+        default=10
+    )
+    server.add_argument(
+        '--proxy-chunk-size',
+        help="bytes of each body chunk proxied to/from the protected "
+             "service. Default: 65536",
+        type=int,
+        default=65536
+    )
+    server.add_argument(
+        '--proxy-max-buffer',
+        help="max bytes of request body buffered for each connection. "
+             "Default: 1048576",
+        type=int,
+        default=1048576
+    )
 
     behavior = parser.add_argument_group("WAF Behavior")
     behavior.add_argument(
@@ -62,11 +139,125 @@ def argument_parser():
              "and blocking mode is enabled, WAF will block a request",
         default="16"
     )
+    behavior.add_argument(
+        '--early-exit',
+        action="store_true",
+        help="in blocking mode, score the most suspicious parameters first "
+             "and block as soon as one is dangerous",
+        default=False
+    )
     behavior.add_argument(
         '-M', '--model',
         help="model used for WAF",
         default="model_feat-5_botneck-101"
     )
+    behavior.add_argument(
+        '--engine',
+        help="runs the model: 'keras' or 'numpy' (doesn't need TensorFlow). "
+             "Default: keras",
+        choices=ENGINES,
+        default="keras"
+    )
+    behavior.add_argument(
+        '--cascade',
+        help="comma separated models, from the cheapest to the most "
+             "expensive, i.e: "
+             "model_feat-3_botneck-20,model_feat-7_botneck-101. Scores "
+             "near the threshold are escalated to the next model",
+        default=None
+    )
+    behavior.add_argument(
+        '--cascade-band',
+        help="distance to the threshold of the scores escalated in the "
+             "cascade mode. Default: 5",
+        type=float,
+        default=5
+    )
+    behavior.add_argument(
+        '--ensemble',
+        help="comma separated models whose scores are averaged",
+        default=None
+    )
+    behavior.add_argument(
+        '--no-bundle',
+        action="store_true",
+        help="load the .h5 model even if there's a compiled bundle of it "
+             "(see: waf-models compile)",
+        default=False
+    )
+    behavior.add_argument(
+        '--score-body',
+        action="store_true",
+        help="also score the fields of form request bodies. Bodies bigger "
+             "than --proxy-max-buffer are rejected",
+        default=False
+    )
+    behavior.add_argument(
+        '--score-cookies',
+        action="store_true",
+        help="also score the request cookies",
+        default=False
+    )
+    behavior.add_argument(
+        '--score-headers',
+        help="comma separated request headers to score too, i.e: "
+             "User-Agent,Referer",
+        default=None
+    )
+
+    inference = parser.add_argument_group("Inference Options")
+    inference.add_argument(
+        '--batch-flush-size',
+        help="number of payload characters that triggers a model call, "
+             "and the most scored in one. Default: 2048",
+        type=int,
+        default=2048
+    )
+    inference.add_argument(
+        '--batch-max-wait',
+        help="max milliseconds a payload waits for its batch. Default: 2",
+        type=float,
+        default=2
+    )
+    inference.add_argument(
+        '--buckets',
+        help="pads the batches of the keras engine up to a bucket of rows, "
+             "traced once: 'pow2' (next power of two) or 'step' (next "
+             "multiple of 64). 'none' traces a dynamic batch size. "
+             "Default: none",
+        choices=BUCKET_SCHEMES,
+        default="none"
+    )
+    inference.add_argument(
+        '--inference-workers',
+        help="threads running the model. Default: 1",
+        type=int,
+        default=1
+    )
+    inference.add_argument(
+        '--inference-queue',
+        help="max payloads waiting for the model. When it's full, requests "
+             "are answered with 503. Default: 1024",
+        type=int,
+        default=1024
+    )
+    inference.add_argument(
+        '--cache-size',
+        help="max verdicts kept in the cache, 0 disables it. Default: 10000",
+        type=int,
+        default=10000
+    )
+    inference.add_argument(
+        '--cache-ttl',
+        help="seconds a verdict is kept in the cache. Default: 300",
+        type=float,
+        default=300
+    )
+    inference.add_argument(
+        '--cache-store',
+        help="SQLite file to share the cached verdicts between workers",
+        default=None
+    )
 
     testing = parser.add_argument_group("Enable testing mode")
     testing.add_argument(
@@ -80,6 +271,33 @@ def argument_parser():
         help="dump file to track each request",
         default="dump.txt"
     )
+    testing.add_argument(
+        '--dump-format',
+        help="format of the dump file: 'text' or 'jsonl' (a JSON object "
+             "per param). Default: text",
+        choices=DUMP_FORMATS,
+        default="text"
+    )
+    testing.add_argument(
+        '--dump-max-bytes',
+        help="size that rotates the dump file, keeping 5 old files. "
+             "Default: 0 (never)",
+        type=int,
+        default=0
+    )
+    testing.add_argument(
+        '--dump-queue',
+        help="max records waiting to be written to the dump file, new ones "
+             "are dropped when it's full. Default: 10000",
+        type=int,
+        default=10000
+    )
+    testing.add_argument(
+        '--weights-occlusion',
+        action="store_true",
+        help="also dump the influence of each letter by occluding it",
+        default=False
+    )
     testing.add_argument(
         '-a', '--access-log',
         action="store_true",
@@ -90,24 +308,331 @@ def argument_parser():
     return parser
 
 
-def list_models():
+def models_argument_parser():
+    parser = argparse.ArgumentParser(
+        description='WAF-brain models'
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser(
+        'list',
+        help="list the available models (default)"
+    )
+
+    compile_models = commands.add_parser(
+        'compile',
+        help="compile models to bundles that load faster than .h5 files"
+    )
+    compile_models.add_argument(
+        'models',
+        nargs="*",
+        help="models to compile. Default: all the available models"
+    )
+    compile_models.add_argument(
+        '-o', '--output',
+        help="bundle path, only when compiling one model. Default: next to "
+             "the .h5 file",
+        default=None
+    )
+    compile_models.add_argument(
+        '--no-benchmark',
+        action="store_true",
+        help="don't compare the loading times of the bundle and the .h5 file",
+        default=False
+    )
+
+    buckets = commands.add_parser(
+        'buckets',
+        help="compare the traces and throughput of the bucket schemes "
+             "(see waf_brain --buckets) over the lengths of some payloads"
+    )
+    buckets.add_argument(
+        'payloads',
+        help="CSV file with the payloads in its first column, i.e: "
+             "client/payloads.csv"
+    )
+    buckets.add_argument(
+        '-M', '--model',
+        help="model to run. Default: model_feat-5_botneck-101",
+        default="model_feat-5_botneck-101"
+    )
+    buckets.add_argument(
+        '--batches',
+        help="number of batches. Default: 300",
+        type=int,
+        default=300
+    )
+    buckets.add_argument(
+        '--max-group',
+        help="max payloads of a batch. Default: 8",
+        type=int,
+        default=8
+    )
+    buckets.add_argument(
+        '--seed',
+        help="seed of the batches. Default: 0",
+        type=int,
+        default=0
+    )
+
+    return parser
+
+
+def bench_argument_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the WAF-brain models in-process: time of '
+                    'each stage, throughput by payload length and batch '
+                    'size and memory high-water mark'
+    )
+    parser.add_argument(
+        'payloads',
+        nargs="?",
+        help="CSV file with the payloads in its first column. Default: "
+             "client/payloads.csv of the repository",
+        default=DEFAULT_PAYLOADS
+    )
+    parser.add_argument(
+        '-M', '--models',
+        nargs="+",
+        help="models to benchmark. Default: all the available models",
+        default=None
+    )
+    parser.add_argument(
+        '-e', '--engine',
+        choices=ENGINES,
+        help="inference engine. Default: keras",
+        default="keras"
+    )
+    parser.add_argument(
+        '--no-bundle',
+        action="store_true",
+        help="load the .h5 files even when there is a compiled bundle",
+        default=False
+    )
+    parser.add_argument(
+        '--variants',
+        help="fuzzed variants of each payload added to the corpus. "
+             "Default: 20",
+        type=int,
+        default=20
+    )
+    parser.add_argument(
+        '--seed',
+        help="seed of the fuzzed variants. Default: 0",
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        '--repeat',
+        help="times each stage is timed, the fastest one is kept. "
+             "Default: 3",
+        type=int,
+        default=3
+    )
+    parser.add_argument(
+        '--no-isolate',
+        action="store_true",
+        help="benchmark every model in this process instead of a new "
+             "process for each one, memory high-water marks add up",
+        default=False
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help="write the results to this JSON file",
+        default=None
+    )
+    parser.add_argument(
+        '--compare',
+        help="JSON file of a previous run to compare the throughput with",
+        default=None
+    )
+    parser.add_argument(
+        '--tolerance',
+        help="slowdown reported as a regression by --compare, exits with "
+             "status 1 when there is one. Default: 0.1 (10%%)",
+        type=float,
+        default=0.1
+    )
+
+    return parser
+
+
+def available_models() -> list:
     models_path = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                                "models"))
 
+    return sorted(
+        m.replace('.h5', '') for m in os.listdir(models_path)
+        if m.endswith("h5")
+    )
+
+
+def list_models():
     print()
     print("Available models: ")
-    for m in os.listdir(models_path):
-        if m.endswith("h5"):
-            print(f"  - {m.replace('.h5', '')}")
+    for m in available_models():
+        print(f"  - {m}")
+    print()
+
+
+def compile_models(models: list, output: str = None, benchmark: bool = True):
+    if output and len(models) != 1:
+        raise SystemExit("--output can only be used to compile one model")
+
+    for m in models:
+        path = model_path(m)
+        if not os.path.exists(path):
+            raise SystemExit(f"Can't find model path: {path}")
+
+        bundle = compile_bundle(path, output)
+
+        print(f"[*] {os.path.basename(path)} -> {bundle}")
+
+        if not benchmark:
+            continue
+
+        for name, loaded in (("h5", path), ("bundle", bundle)):
+            timing = benchmark_loading(loaded)
+            print(f"    {name:<7} import: {timing['import']:.3f}s - "
+                  f"load: {timing['load']:.3f}s - "
+                  f"first inference: {timing['first_inference']:.3f}s")
+
+
+def benchmark_bucket_schemes(payloads: str,
+                             model: str,
+                             batches: int = 300,
+                             max_group: int = 8,
+                             seed: int = 0):
+    from keras.models import load_model
+    from waf_brain.benchmarks import (
+        read_payloads, payload_batches, benchmark_buckets
+    )
+
+    path = model_path(model)
+    if not os.path.exists(path):
+        raise SystemExit(f"Can't find model path: {path}")
+
+    keras_model = load_model(path)
+    windows = payload_batches(read_payloads(payloads),
+                              int(keras_model.input_shape[1]),
+                              batches,
+                              max_group,
+                              seed)
+
+    sizes = [len(w) for w in windows]
+    print(f"[*] {len(windows)} batches - {len(set(sizes))} batch sizes "
+          f"from {min(sizes)} to {max(sizes)} windows")
+    print()
+    print(f"    {'scheme':<7} {'traces':>6} {'shapes':>6} {'padding':>8} "
+          f"{'1st pass':>9} {'1st w/s':>9} {'w/s':>9}")
+
+    for scheme, r in benchmark_buckets(keras_model, windows).items():
+        print(f"    {scheme:<7} {r['traces']:>6} {r['shapes']:>6} "
+              f"{r['padding']:>8.1%} {r['first_pass']:>8.2f}s "
+              f"{r['windows_per_second_first']:>9.0f} "
+              f"{r['windows_per_second']:>9.0f}")
+
+
+def models():
+    parsed_cmd = models_argument_parser().parse_args()
+
+    if parsed_cmd.command == "compile":
+        compile_models(parsed_cmd.models or available_models(),
+                       parsed_cmd.output,
+                       not parsed_cmd.no_benchmark)
+    elif parsed_cmd.command == "buckets":
+        benchmark_bucket_schemes(parsed_cmd.payloads,
+                                 parsed_cmd.model,
+                                 parsed_cmd.batches,
+                                 parsed_cmd.max_group,
+                                 parsed_cmd.seed)
+    else:
+        list_models()
+
+
+def print_benchmark(model: str, r: dict):
+    print(f"[*] {model} - {r['payloads']} payloads - {r['windows']} "
+          f"windows")
+    print("    " + " - ".join(
+        f"{stage}: {seconds:.3f}s" for stage, seconds in r["stages"].items()
+    ))
+    print(f"    {r['payloads_per_second']:.0f} payloads/s - "
+          f"{r['windows_per_second']:.0f} windows/s - "
+          f"peak memory {r['memory']['peak'] / 2 ** 20:.0f} MiB")
+
+    print(f"    {'length':<8} {'payloads':>8} {'mean':>7} {'payloads/s':>10} "
+          f"{'ms':>7}")
+    for bucket, b in r["by_length"].items():
+        print(f"    {bucket:<8} {b['payloads']:>8} {b['mean_length']:>7.0f} "
+              f"{b['payloads_per_second']:>10.0f} "
+              f"{b['ms_per_payload']:>7.3f}")
+
+    print(f"    {'batch':<8} {'ms':>9} {'windows/s':>10}")
+    for size, b in r["batch_scaling"].items():
+        print(f"    {size:<8} {b['ms']:>9.3f} "
+              f"{b['windows_per_second']:>10.0f}")
     print()
 
 
+def bench():
+    parsed_cmd = bench_argument_parser().parse_args()
+
+    from waf_brain.benchmarks import run_benchmarks, compare_results
+
+    if not os.path.exists(parsed_cmd.payloads):
+        raise SystemExit(f"Can't find payloads file: {parsed_cmd.payloads}")
+
+    results = run_benchmarks(parsed_cmd.models or available_models(),
+                             parsed_cmd.payloads,
+                             parsed_cmd.variants,
+                             parsed_cmd.seed,
+                             parsed_cmd.engine,
+                             not parsed_cmd.no_bundle,
+                             parsed_cmd.repeat,
+                             not parsed_cmd.no_isolate)
+
+    print()
+    for model, r in results["models"].items():
+        print_benchmark(model, r)
+
+    if parsed_cmd.output:
+        with open(parsed_cmd.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"[*] Results written to {parsed_cmd.output}")
+
+    if not parsed_cmd.compare:
+        return
+
+    with open(parsed_cmd.compare, "r") as f:
+        previous = json.load(f)
+
+    print(f"[*] Compared with {parsed_cmd.compare} ({previous['date']})")
+    if previous["engine"] != results["engine"]:
+        print(f"    engines differ: {previous['engine']} -> "
+              f"{results['engine']}")
+
+    regressions = 0
+    for model, metric, before, after, change, regression in \
+            compare_results(previous, results, parsed_cmd.tolerance):
+        regressions += regression
+
+        print(f"    {model:<28} {metric:<20} {before:>9.0f} -> "
+              f"{after:>9.0f} {change:>+7.1%}"
+              f"{' REGRESSION' if regression else ''}")
+
+    if regressions:
+        raise SystemExit(1)
+
+
 def serve():
 
     parser = argument_parser()
     parsed_cmd = parser.parse_args()
 
     # set logger level
+    logging.basicConfig(
+        format="[%(asctime)s] [%(process)d] [%(levelname)s] %(message)s"
+    )
     log.setLevel(get_log_level(parsed_cmd.verbosity))
 
     #
@@ -131,6 +656,7 @@ def serve():
         host=parsed_cmd.listen,
         port=int(parsed_cmd.port),
         backlog=int(parsed_cmd.backlog),
+        workers=parsed_cmd.workers,
         access_log=parsed_cmd.access_log)
 
 
@@ -0,0 +1,417 @@
+import os
+import csv
+import sys
+import json
+import time
+import random
+import platform
+import resource
+import subprocess
+
+from datetime import datetime
+
+import numpy as np
+
+from waf_brain.engines import KerasEngine, BUCKET_SCHEMES, bucket_rows
+from waf_brain.helpers import memory_usage
+from waf_brain.inferring import (
+    encode_payload, window_indices, model_features, accuracy_scores,
+    score_payloads
+)
+
+# Upper bounds of the payload lengths the throughput is reported by
+LENGTH_BUCKETS = (16, 64, 256, 1024, 4096)
+
+# Windows of each model call of the batch size scaling curves
+BATCH_SIZES = (1, 8, 64, 512, 2048, 8192)
+
+# Windows of each model call when the whole corpus is scored
+CORPUS_BATCH = 2048
+
+# Metrics compared between runs, where higher is better
+COMPARED_METRICS = ("payloads_per_second", "windows_per_second")
+
+
+def read_payloads(path: str) -> list:
+    """Payloads of the first column of a CSV file with a header row"""
+    with open(path, newline="") as f:
+        rows = csv.reader(f)
+        next(rows, None)
+
+        return [row[0] for row in rows if row]
+
+
+def payload_batches(payloads: list,
+                    x_features: int,
+                    batches: int = 300,
+                    max_group: int = 8,
+                    seed: int = 0) -> list:
+    """
+    Windows of `batches` batches of 1 to `max_group` payloads drawn from
+    `payloads`, as the batcher would group requests arriving together.
+    Payloads out of the vocabulary are skipped.
+    """
+    windows = []
+    for payload in payloads:
+        try:
+            windows.append(window_indices(encode_payload(payload),
+                                          x_features)[0])
+        except ValueError:
+            continue
+
+    if not windows:
+        raise ValueError("no payload in the vocabulary")
+
+    rng = random.Random(seed)
+
+    return [
+        np.concatenate(rng.choices(windows, k=rng.randint(1, max_group)))
+        for _ in range(batches)
+    ]
+
+
+def benchmark_buckets(keras_model,
+                      batches: list,
+                      schemes: tuple = ("exact",) + BUCKET_SCHEMES) -> dict:
+    """
+    Run the batches through a KerasEngine with each bucket scheme. `exact`
+    traces a function for each batch size, as calling the model with
+    variable shapes would.
+
+    The first pass includes the tracing, the second one doesn't. The
+    throughput counts the windows of the payloads, not the padded ones.
+    """
+    windows = sum(len(batch) for batch in batches)
+
+    results = {}
+    for scheme in schemes:
+        engine = KerasEngine(keras_model, buckets=scheme)
+
+        elapsed = []
+        for _ in range(2):
+            before_time = time.perf_counter()
+            for batch in batches:
+                engine.predict(batch)
+            elapsed.append(time.perf_counter() - before_time)
+
+        sizes = [bucket_rows(len(batch), scheme) for batch in batches]
+
+        results[scheme] = {
+            "traces": engine.traces,
+            "shapes": len(set(sizes)),
+            "padding": sum(sizes) / windows - 1,
+            "first_pass": elapsed[0],
+            "windows_per_second_first": windows / elapsed[0],
+            "windows_per_second": windows / elapsed[1],
+        }
+
+    return results
+
+
+def mutate(payload: str, rng: random.Random) -> str:
+    """
+    A variant of the payload, as a fuzzer would write it.
+
+    The SqlFuzzer of the client isn't used: it's not part of the package,
+    and the corpus must stay the same as its strategies change, so the runs
+    compared by `compare_results` score the same payloads.
+    """
+    mutation = rng.randrange(5)
+
+    if mutation == 0:
+        return "".join(
+            c.swapcase() if rng.random() < 0.5 else c for c in payload
+        )
+
+    if mutation == 1:
+        return payload.replace(" ", rng.choice(("/**/", "\t", "  ", "+")))
+
+    if mutation == 2:
+        i = rng.randint(0, len(payload))
+        return payload[:i] + "/*" + str(rng.randrange(1000)) + "*/" + \
+            payload[i:]
+
+    if mutation == 3:
+        return payload.replace("'", "%27").replace("=", "%3D")
+
+    # Longer payloads
+    return payload + " " + payload
+
+
+def fuzz_variants(payloads: list, variants: int, seed: int = 0) -> list:
+    """`variants` fuzzed variants of each payload, chaining mutations"""
+    rng = random.Random(seed)
+
+    result = []
+    for payload in payloads:
+        variant = payload
+        for _ in range(variants):
+            variant = mutate(variant, rng)
+
+            # Doubling them again and again would only measure huge ones
+            if len(variant) > 4 * len(payload):
+                variant = mutate(payload, rng)
+            result.append(variant)
+
+    return result
+
+
+def corpus(payloads_path: str, variants: int, seed: int = 0) -> list:
+    """The payloads of the CSV file and their fuzzed variants"""
+    payloads = read_payloads(payloads_path)
+
+    return payloads + fuzz_variants(payloads, variants, seed)
+
+
+def length_bucket(length: int) -> str:
+    for bound in LENGTH_BUCKETS:
+        if length <= bound:
+            return f"<={bound}"
+
+    return f">{LENGTH_BUCKETS[-1]}"
+
+
+def best_time(function, repeat: int) -> float:
+    """Seconds of the fastest of `repeat` calls"""
+    times = []
+    for _ in range(repeat):
+        before_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - before_time)
+
+    return min(times)
+
+
+def peak_memory() -> int:
+    """High-water mark of the resident memory of this process, in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # In bytes on macOS, in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def benchmark_model(model: str,
+                    payloads: list,
+                    engine: str = "keras",
+                    use_bundle: bool = True,
+                    repeat: int = 3,
+                    batch_sizes: tuple = BATCH_SIZES) -> dict:
+    """
+    Time each stage of scoring the payloads with a model, in this process:
+    loading it, its first call, featurizing the payloads, the forward pass,
+    the scores and all of them together. Also the throughput by payload
+    length, scoring them one by one, and the throughput of the model by
+    batch size.
+
+    Payloads out of the vocabulary are left out.
+    """
+    from waf_brain.data import resolve_model
+    from waf_brain.service.inference import load_engine
+    from waf_brain.service.startup import StartupPhases
+
+    model_path, model_bundle = resolve_model(model, use_bundle)
+
+    stages = StartupPhases()
+    loaded = load_engine({"MODEL_CHAIN": [(model_path, model_bundle)],
+                          "ENGINE": engine,
+                          "BUCKETS": "none"},
+                         model_path,
+                         model_bundle,
+                         stages)
+    memory_loaded = memory_usage()
+
+    x_features = model_features(loaded)
+
+    payloads = [p for p in payloads if _in_vocabulary(p)]
+
+    with stages.phase("first_inference"):
+        loaded.predict(window_indices(encode_payload("select 1"),
+                                      x_features)[0])
+
+    featurized = []
+
+    def featurize():
+        featurized[:] = [
+            window_indices(encode_payload(p), x_features) for p in payloads
+        ]
+
+    stages.phases["featurize"] = best_time(featurize, repeat)
+
+    windows = np.concatenate([w for w, _ in featurized])
+    targets = np.concatenate([t for _, t in featurized])
+    sizes = [len(t) for _, t in featurized]
+
+    predictions = []
+
+    def forward():
+        predictions[:] = [
+            loaded.predict(windows[i:i + CORPUS_BATCH])
+            for i in range(0, len(windows), CORPUS_BATCH)
+        ]
+
+    stages.phases["forward"] = best_time(forward, repeat)
+    predictions = np.concatenate(predictions)
+
+    stages.phases["score"] = best_time(
+        lambda: accuracy_scores(predictions, targets, sizes),
+        repeat
+    )
+
+    # As the batcher does it: featurized and scored in the same call
+    stages.phases["end_to_end"] = best_time(
+        lambda: [
+            score_payloads(loaded, payloads[i:i + 64])
+            for i in range(0, len(payloads), 64)
+        ],
+        repeat
+    )
+
+    by_length = {}
+    for bucket in [length_bucket(b) for b in LENGTH_BUCKETS] + \
+            [length_bucket(LENGTH_BUCKETS[-1] + 1)]:
+        group = [p for p in payloads if length_bucket(len(p)) == bucket]
+        if not group:
+            continue
+
+        seconds = best_time(
+            lambda: [score_payloads(loaded, [p]) for p in group],
+            repeat
+        )
+        by_length[bucket] = {
+            "payloads": len(group),
+            "mean_length": float(np.mean([len(p) for p in group])),
+            "payloads_per_second": len(group) / seconds,
+            "ms_per_payload": seconds / len(group) * 1000,
+        }
+
+    batch_scaling = {}
+    for size in batch_sizes:
+        batch = np.resize(windows, (size, windows.shape[1]))
+        seconds = best_time(lambda: loaded.predict(batch), repeat)
+        batch_scaling[str(size)] = {
+            "ms": seconds * 1000,
+            "windows_per_second": size / seconds,
+        }
+
+    return {
+        "path": model_bundle or model_path,
+        "engine": engine,
+        "payloads": len(payloads),
+        "windows": len(windows),
+        "stages": dict(stages.phases),
+        "payloads_per_second": len(payloads) /
+        stages.phases["end_to_end"],
+        "windows_per_second": len(windows) / stages.phases["forward"],
+        "by_length": by_length,
+        "batch_scaling": batch_scaling,
+        "memory": {
+            "loaded": memory_loaded,
+            "peak": peak_memory(),
+        },
+    }
+
+
+def _in_vocabulary(payload: str) -> bool:
+    try:
+        encode_payload(payload)
+    except ValueError:
+        return False
+
+    return True
+
+
+def benchmark_model_process(model: str,
+                            payloads_path: str,
+                            variants: int,
+                            seed: int,
+                            engine: str = "keras",
+                            use_bundle: bool = True,
+                            repeat: int = 3) -> dict:
+    """
+    benchmark_model in a new process, so each model is loaded from scratch
+    and its memory high-water mark is its own.
+    """
+    result = subprocess.run(
+        [sys.executable, "-m", "waf_brain.benchmarks", model, payloads_path,
+         str(variants), str(seed), engine, str(int(use_bundle)),
+         str(repeat)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True
+    )
+
+    return json.loads(result.stdout.decode().splitlines()[-1])
+
+
+def run_benchmarks(models: list,
+                   payloads_path: str,
+                   variants: int = 20,
+                   seed: int = 0,
+                   engine: str = "keras",
+                   use_bundle: bool = True,
+                   repeat: int = 3,
+                   isolate: bool = True) -> dict:
+    """Benchmark each model, with the metadata to compare runs"""
+    results = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "payloads_file": os.path.abspath(payloads_path),
+        "variants": variants,
+        "seed": seed,
+        "engine": engine,
+        "repeat": repeat,
+        "models": {},
+    }
+
+    for model in models:
+        if isolate:
+            results["models"][model] = benchmark_model_process(
+                model, payloads_path, variants, seed, engine, use_bundle,
+                repeat
+            )
+        else:
+            results["models"][model] = benchmark_model(
+                model, corpus(payloads_path, variants, seed), engine,
+                use_bundle, repeat
+            )
+
+    return results
+
+
+def compare_results(old: dict, new: dict, tolerance: float = 0.1) -> list:
+    """
+    (model, metric, old, new, change, regression) of the metrics of the
+    models in both runs. A change below -`tolerance` is a regression.
+    """
+    changes = []
+    for model, result in new["models"].items():
+        if model not in old["models"]:
+            continue
+
+        for metric in COMPARED_METRICS:
+            before, after = old["models"][model][metric], result[metric]
+            change = after / before - 1 if before else 0.0
+            changes.append((model, metric, before, after, change,
+                            change < -tolerance))
+
+    return changes
+
+
+__all__ = ("read_payloads", "payload_batches", "benchmark_buckets",
+           "fuzz_variants", "corpus", "benchmark_model", "run_benchmarks",
+           "compare_results")
+
+
+if __name__ == '__main__':
+    model, payloads_path, variants, seed, engine, use_bundle, repeat = \
+        sys.argv[1:8]
+
+    print(json.dumps(benchmark_model(
+        model,
+        corpus(payloads_path, int(variants), int(seed)),
+        engine,
+        bool(int(use_bundle)),
+        int(repeat)
+    )))
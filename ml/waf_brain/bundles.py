@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import time
+import logging
+import subprocess
+
+import numpy as np
+
+from waf_brain.cache import model_identity
+from waf_brain.exceptions import WAFBrainException
+
+log = logging.getLogger("waf-brain")
+
+BUNDLE_FORMAT = 1
+BUNDLE_SUFFIX = ".bundle"
+MANIFEST_FILE = "manifest.json"
+
+
+def bundle_path(model_path: str) -> str:
+    """Path of the compiled bundle of a .h5 model"""
+    return f"{os.path.splitext(model_path)[0]}{BUNDLE_SUFFIX}"
+
+
+def read_manifest(path: str) -> dict:
+    with open(os.path.join(path, MANIFEST_FILE), "r") as f:
+        manifest = json.load(f)
+
+    if manifest.get("format") != BUNDLE_FORMAT:
+        raise WAFBrainException(f"Unknown model bundle format: {path}")
+
+    return manifest
+
+
+def is_up_to_date(path: str, model_path: str) -> bool:
+    """The bundle exists and it was compiled from this .h5 file"""
+    try:
+        manifest = read_manifest(path)
+    except (OSError, ValueError, WAFBrainException):
+        return False
+
+    if not os.path.exists(model_path):
+        return True
+
+    stat = os.stat(model_path)
+
+    return manifest["source"]["size"] == stat.st_size and \
+        manifest["source"]["mtime_ns"] == stat.st_mtime_ns
+
+
+def compile_bundle(model_path: str, output: str = None) -> str:
+    """
+    Export a .h5 model to a bundle: the Keras config of the model and one
+    .npy file for each weight, that can be memory mapped.
+    """
+    from keras.models import load_model
+
+    output = output or bundle_path(model_path)
+    os.makedirs(output, exist_ok=True)
+
+    model = load_model(model_path)
+    stat = os.stat(model_path)
+
+    weights = []
+    for i, (variable, value) in enumerate(zip(model.weights,
+                                              model.get_weights())):
+        file_name = f"weight_{i:02d}.npy"
+        np.save(os.path.join(output, file_name), value)
+
+        weights.append({
+            "file": file_name,
+            "name": variable.name,
+            "shape": list(value.shape),
+            "dtype": str(value.dtype)
+        })
+
+    manifest = {
+        "format": BUNDLE_FORMAT,
+        "name": os.path.basename(os.path.splitext(model_path)[0]),
+        "identity": model_identity(model_path),
+        "source": {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns
+        },
+        "x_features": int(model.input_shape[1]),
+        "config": model.to_json(),
+        "weights": weights
+    }
+
+    # The manifest goes last, a half written bundle isn't valid
+    with open(os.path.join(output, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return output
+
+
+def load_bundle_weights(path: str, mmap: bool = True) -> list:
+    """(name, array) of each weight of a bundle, memory mapped by default"""
+    return [
+        (weight["name"],
+         np.load(os.path.join(path, weight["file"]),
+                 mmap_mode="r" if mmap else None))
+        for weight in read_manifest(path)["weights"]
+    ]
+
+
+def load_bundle(path: str):
+    """Build the Keras model of a bundle"""
+    from keras.models import model_from_json
+
+    manifest = read_manifest(path)
+
+    model = model_from_json(manifest["config"])
+    model.set_weights([w for _, w in load_bundle_weights(path)])
+
+    return model
+
+
+def time_loading(path: str) -> dict:
+    """
+    Seconds to import Keras, to load a .h5 model or a bundle and to run it
+    for the first time, in this process.
+    """
+    before_time = time.perf_counter()
+    from keras.models import load_model
+    from waf_brain.engines import KerasEngine
+    from waf_brain.inferring import (
+        encode_payload, window_indices, model_features
+    )
+    imported = time.perf_counter()
+
+    if path.endswith(BUNDLE_SUFFIX):
+        engine = KerasEngine(load_bundle(path))
+    else:
+        engine = KerasEngine(load_model(path))
+    loaded = time.perf_counter()
+
+    windows, _ = window_indices(encode_payload("select * from users"),
+                                model_features(engine))
+    engine.predict(windows)
+
+    return {
+        "import": imported - before_time,
+        "load": loaded - imported,
+        "first_inference": time.perf_counter() - loaded
+    }
+
+
+def benchmark_loading(path: str) -> dict:
+    """time_loading of a .h5 model or a bundle, in a new process"""
+    result = subprocess.run(
+        [sys.executable, "-m", "waf_brain.bundles", path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True
+    )
+
+    return json.loads(result.stdout.decode().splitlines()[-1])
+
+
+__all__ = ("bundle_path", "read_manifest", "is_up_to_date", "compile_bundle",
+           "load_bundle", "load_bundle_weights", "time_loading",
+           "benchmark_loading")
+
+
+if __name__ == '__main__':
+    print(json.dumps(time_loading(sys.argv[1])))
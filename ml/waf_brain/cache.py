@@ -0,0 +1,238 @@
+import os
+import time
+import json
+import asyncio
+import sqlite3
+import hashlib
+import logging
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("waf-brain")
+
+
+def model_identity(model_path: str) -> str:
+    """Identify a model file by its path, size and modification time"""
+    stat = os.stat(model_path)
+
+    return f"{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class SqliteVerdictStore:
+    """
+    Verdicts stored in a local SQLite file, so the Sanic workers of the
+    same host share them.
+
+    The file is only used from a thread of its own, off the event loop.
+    Reads are awaited, writes are queued and written together behind the
+    requests.
+    """
+
+    # Keys of each read query, below the SQLite limit of variables
+    READ_CHUNK = 500
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+
+        self._db = sqlite3.connect(path,
+                                   timeout=1,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts ("
+            "key TEXT PRIMARY KEY, value TEXT, created REAL)"
+        )
+        # To trim the oldest verdicts
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS verdicts_created "
+            "ON verdicts (created)"
+        )
+
+        self._thread = ThreadPoolExecutor(max_workers=1,
+                                          thread_name_prefix="verdicts")
+        self._pending = deque()
+        self._flushing = False
+        self._writes = 0
+
+    async def get_many(self, keys: list, not_before: float) -> dict:
+        """Stored values of the keys, as a dict without the missing ones"""
+        return await asyncio.get_event_loop().run_in_executor(
+            self._thread, self._read, keys, not_before
+        )
+
+    def set(self, key: str, value: dict, created: float):
+        self._pending.append((key, json.dumps(value), created))
+
+        if not self._flushing:
+            self._flushing = True
+            self._thread.submit(self._flush)
+
+    def _read(self, keys: list, not_before: float) -> dict:
+        values = {}
+        for i in range(0, len(keys), self.READ_CHUNK):
+            chunk = keys[i:i + self.READ_CHUNK]
+            values.update(
+                (key, json.loads(value))
+                for key, value in self._db.execute(
+                    f"SELECT key, value FROM verdicts WHERE key IN "
+                    f"({','.join('?' * len(chunk))}) AND created >= ?",
+                    (*chunk, not_before)
+                )
+            )
+
+        return values
+
+    def _flush(self):
+        # Writes queued from now on need another flush
+        self._flushing = False
+
+        rows = []
+        while self._pending:
+            rows.append(self._pending.popleft())
+
+        if not rows:
+            return
+
+        try:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)",
+                    rows
+                )
+
+            # Trim the oldest verdicts from time to time
+            before, self._writes = self._writes, self._writes + len(rows)
+            if before // 1000 != self._writes // 1000:
+                self._db.execute(
+                    "DELETE FROM verdicts WHERE key IN ("
+                    "SELECT key FROM verdicts ORDER BY created DESC "
+                    "LIMIT -1 OFFSET ?)",
+                    (self.max_size, )
+                )
+        except sqlite3.Error as e:
+            log.warning(f"can't write the verdicts store: {e}")
+
+    def close(self):
+        """Write the verdicts still queued and close the file"""
+        self._thread.submit(self._flush)
+        self._thread.shutdown(wait=True)
+        self._db.close()
+
+
+class VerdictCache:
+    """
+    Bounded LRU cache of the verdicts of the model, with a TTL.
+
+    Keys are a hash of the model identity, the kind of verdict (a plain
+    score or the simulator weights) and the payload. When `store` is a
+    file path, the verdicts are also shared through a SQLite store.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300, store=None):
+        self.max_size = int(max_size)
+        self.ttl = float(ttl)
+
+        self._entries = OrderedDict()
+        self._store = SqliteVerdictStore(store, self.max_size) \
+            if store else None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(model_id: str, kind: str, payload: str) -> str:
+        return hashlib.blake2b(
+            "\0".join((model_id, kind, payload)).encode("utf-8",
+                                                        "surrogatepass"),
+            digest_size=16
+        ).hexdigest()
+
+    async def get(self, model_id: str, kind: str, payload: str):
+        return (await self.get_many(model_id, kind, [payload]))[0]
+
+    async def get_many(self, model_id: str, kind: str, payloads: list) -> list:
+        """
+        Cached verdicts of the payloads, None for the missing ones. The
+        store is read once, for the payloads missing in memory.
+        """
+        keys = [self.key(model_id, kind, payload) for payload in payloads]
+        now = time.time()
+
+        values = [self._recall(key, now) for key in keys]
+
+        missing = [i for i, value in enumerate(values) if value is None]
+        if self._store and missing:
+            try:
+                stored = await self._store.get_many(
+                    list({keys[i] for i in missing}), now - self.ttl
+                )
+            except sqlite3.Error as e:
+                log.warning(f"can't read the verdicts store: {e}")
+                stored = {}
+
+            for i in missing:
+                values[i] = stored.get(keys[i])
+                if values[i] is not None:
+                    self._remember(keys[i], values[i], now)
+
+        for value in values:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return values
+
+    def set(self, model_id: str, kind: str, payload: str, value: dict):
+        key = self.key(model_id, kind, payload)
+        now = time.time()
+
+        self._remember(key, value, now)
+
+        if self._store:
+            self._store.set(key, value, now)
+
+    def _recall(self, key: str, now: float):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        created, value = entry
+        if created + self.ttl >= now:
+            self._entries.move_to_end(key)
+            return value
+
+        del self._entries[key]
+        self.evictions += 1
+        return None
+
+    def _remember(self, key: str, value: dict, created: float):
+        self._entries[key] = (created, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "shared": self._store.path if self._store else None
+        }
+
+    def close(self):
+        if self._store:
+            self._store.close()
+
+
+__all__ = ("VerdictCache", "model_identity")
@@ -2,9 +2,49 @@ import os.path
 
 from argparse import Namespace
 
+from waf_brain.bundles import bundle_path, is_up_to_date
 from waf_brain.exceptions import WAFBrainException
 
 
+def model_path(model: str) -> str:
+    """
+    Absolute path of the .h5 file of a model: a local file or one of the
+    models of the package.
+    """
+    if not model.endswith("h5"):
+        model = f"{model}.h5"
+
+    # If exists in local path -> get absolute path
+    if os.path.exists(model) or os.path.exists(bundle_path(model)):
+        return os.path.abspath(model)
+
+    # Get local model
+    return os.path.abspath(
+        os.path.join(
+            os.path.dirname(__file__),
+            "models",
+            model
+        )
+    )
+
+
+def resolve_model(model: str, use_bundle: bool = True) -> tuple:
+    """
+    Paths of the .h5 file of a model and of its compiled bundle, None if
+    there's no bundle up to date or it's not wanted.
+    """
+    model = model_path(model)
+    bundle = bundle_path(model)
+
+    if not use_bundle or not is_up_to_date(bundle, model):
+        bundle = None
+
+    if not os.path.exists(model) and not bundle:
+        raise WAFBrainException(f"Can't find model path: {model}")
+
+    return model, bundle
+
+
 class WAFBrainRunningConfig:
 
     def __init__(self,
@@ -15,10 +55,43 @@ class WAFBrainRunningConfig:
                  blocking_mode: bool = False,
                  blocking_threshold: int = 25,
                  model: str = "model_feat-5_botneck-101",
+                 use_bundle: bool = True,
+                 engine: str = "keras",
+                 cascade: str = None,
+                 cascade_band: float = 5,
+                 ensemble: str = None,
+                 score_body: bool = False,
+                 score_cookies: bool = False,
+                 score_headers: str = None,
+                 early_exit: bool = False,
                  dump_file: str = "dump.txt",
+                 dump_format: str = "text",
+                 dump_max_bytes: int = 0,
+                 dump_queue: int = 10000,
                  enable_testing: bool = False,
+                 weights_occlusion: bool = False,
                  timeout_backend: int = 5,
-                 backlog: int = 512):
+                 backlog: int = 512,
+                 upstream_pool_size: int = 100,
+                 upstream_per_host: int = 0,
+                 upstream_keepalive: float = 15,
+                 upstream_dns_ttl: int = 10,
+                 proxy_chunk_size: int = 65536,
+                 proxy_max_buffer: int = 1048576,
+                 batch_flush_size: int = 2048,
+                 batch_max_wait: float = 2,
+                 buckets: str = "none",
+                 inference_workers: int = 1,
+                 inference_queue: int = 1024,
+                 cache_size: int = 10000,
+                 cache_ttl: float = 300,
+                 cache_store: str = None,
+                 admin_token: str = None,
+                 metrics_path: str = "/metrics",
+                 debug_sample_rate: float = 0.01):
+
+        # To build a changed config on reload
+        self.arguments = {k: v for k, v in locals().items() if k != "self"}
 
         self.backlog = backlog
         self.verbosity = verbosity
@@ -26,8 +99,37 @@ class WAFBrainRunningConfig:
         self.listen_addr = listen_addr
         self.protected_url = protected_url
         self.enable_testing = bool(enable_testing)
+        self.weights_occlusion = bool(weights_occlusion)
+        self.dump_format = dump_format
+        self.dump_max_bytes = int(dump_max_bytes)
+        self.dump_queue = int(dump_queue)
         self.blocking_mode = blocking_mode
+        self.engine = engine
+        self.early_exit = bool(early_exit)
+        self.score_body = bool(score_body)
+        self.score_cookies = bool(score_cookies)
+        self.score_headers = [
+            h.strip() for h in (score_headers or "").split(",") if h.strip()
+        ]
         self.timeout_backend = int(timeout_backend)
+        self.upstream_pool_size = int(upstream_pool_size)
+        self.upstream_per_host = int(upstream_per_host)
+        self.upstream_keepalive = float(upstream_keepalive)
+        self.upstream_dns_ttl = int(upstream_dns_ttl)
+        self.proxy_chunk_size = int(proxy_chunk_size)
+        self.proxy_max_buffer = int(proxy_max_buffer)
+        self.batch_flush_size = int(batch_flush_size)
+        self.batch_max_wait = float(batch_max_wait)
+        self.buckets = buckets
+        self.inference_workers = int(inference_workers)
+        self.inference_queue = int(inference_queue)
+        self.cache_size = int(cache_size)
+        self.cache_ttl = float(cache_ttl)
+        self.cache_store = os.path.abspath(cache_store) \
+            if cache_store else None
+        self.admin_token = admin_token
+        self.metrics_path = "/" + metrics_path.lstrip("/")
+        self.debug_sample_rate = float(debug_sample_rate)
         self.blocking_threshold = 0
         if blocking_threshold:
             self.blocking_threshold = int(blocking_threshold)
@@ -35,29 +137,31 @@ class WAFBrainRunningConfig:
         self.blocking_threshold /= 100
 
         #
-        # Fix model path
+        # Models used to score: one, or a chain of them for the cascade and
+        # ensemble modes
         #
-        if not model.endswith("h5"):
-            model = f"{model}.h5"
+        if cascade and ensemble:
+            raise WAFBrainException("Cascade and ensemble modes can't be "
+                                    "used together")
 
-        # If exists in local path -> get absolute path
-        if os.path.exists(model):
-            os.path.abspath(model)
+        self.scoring = "single"
+        chain = [model]
+        if cascade or ensemble:
+            self.scoring = "cascade" if cascade else "ensemble"
+            chain = [m.strip() for m in (cascade or ensemble).split(",")
+                     if m.strip()]
 
-        else:
-            # Get local model
-            model = os.path.abspath(
-                os.path.join(
-                    os.path.dirname(__file__),
-                    "models",
-                    model
-                )
-            )
+            if len(chain) < 2:
+                raise WAFBrainException(f"The {self.scoring} mode needs at "
+                                        f"least two models")
 
-        if not os.path.exists(model):
-            raise WAFBrainException(f"Can't find model path: {model}")
+        self.cascade_band = float(cascade_band) / 100
 
-        self.model = model
+        #
+        # Fix model paths. The compiled bundles of the models are preferred
+        #
+        self.model_chain = [resolve_model(m, use_bundle) for m in chain]
+        self.model, self.model_bundle = self.model_chain[0]
 
         #
         # Fix dump file
@@ -83,11 +187,45 @@ class WAFBrainRunningConfig:
             listen_port=argparser_input.port,
             backlog=argparser_input.backlog,
             timeout_backend=argparser_input.backend_timeout,
+            upstream_pool_size=argparser_input.upstream_pool_size,
+            upstream_per_host=argparser_input.upstream_per_host,
+            upstream_keepalive=argparser_input.upstream_keepalive,
+            upstream_dns_ttl=argparser_input.upstream_dns_ttl,
+            proxy_chunk_size=argparser_input.proxy_chunk_size,
+            proxy_max_buffer=argparser_input.proxy_max_buffer,
             enable_testing=argparser_input.enable_testing,
+            weights_occlusion=argparser_input.weights_occlusion,
             dump_file=argparser_input.dump_file,
-            model=argparser_input.model
+            dump_format=argparser_input.dump_format,
+            dump_max_bytes=argparser_input.dump_max_bytes,
+            dump_queue=argparser_input.dump_queue,
+            model=argparser_input.model,
+            use_bundle=not argparser_input.no_bundle,
+            engine=argparser_input.engine,
+            cascade=argparser_input.cascade,
+            cascade_band=argparser_input.cascade_band,
+            ensemble=argparser_input.ensemble,
+            early_exit=argparser_input.early_exit,
+            score_body=argparser_input.score_body,
+            score_cookies=argparser_input.score_cookies,
+            score_headers=argparser_input.score_headers,
+            batch_flush_size=argparser_input.batch_flush_size,
+            batch_max_wait=argparser_input.batch_max_wait,
+            buckets=argparser_input.buckets,
+            inference_workers=argparser_input.inference_workers,
+            inference_queue=argparser_input.inference_queue,
+            cache_size=argparser_input.cache_size,
+            cache_ttl=argparser_input.cache_ttl,
+            cache_store=argparser_input.cache_store,
+            admin_token=argparser_input.admin_token,
+            metrics_path=argparser_input.metrics_path,
+            debug_sample_rate=argparser_input.debug_sample_rate
         )
 
+    def with_changes(self, **changes):
+        """New config with some arguments changed"""
+        return WAFBrainRunningConfig(**{**self.arguments, **changes})
+
     @property
     def to_dict(self) -> dict:
         return {
@@ -96,4 +234,4 @@ class WAFBrainRunningConfig:
         }
 
 
-__all__ = ("WAFBrainRunningConfig",)
\ No newline at end of file
+__all__ = ("WAFBrainRunningConfig", "model_path", "resolve_model")
\ No newline at end of file
@@ -0,0 +1,367 @@
+import json
+import threading
+
+import h5py
+import numpy as np
+
+from waf_brain.exceptions import WAFBrainException
+from waf_brain.inferring import ONE_HOT_SIZE, one_hot_windows
+
+
+BUCKET_SCHEMES = ("none", "pow2", "step")
+
+BUCKET_STEP = 64
+
+
+def bucket_rows(rows: int, scheme: str) -> int:
+    """
+    Rows a batch of `rows` windows is padded to: the next power of two for
+    `pow2`, the next multiple of BUCKET_STEP for `step`. Other schemes
+    don't pad it.
+    """
+    if scheme == "pow2":
+        return 1 << max(rows - 1, 0).bit_length()
+
+    if scheme == "step":
+        return -(-rows // BUCKET_STEP) * BUCKET_STEP
+
+    return rows
+
+
+class KerasEngine:
+    """
+    Forward pass of a Keras model.
+
+    The model is called directly through a `tf.function`, skipping the loss,
+    metrics, callbacks and progress machinery of `evaluate` and `predict`.
+
+    A `tf.function` traces a new graph for each distinct input shape, so
+    for each distinct batch size. With `buckets` set to `none` its input
+    signature has a dynamic batch size instead: it's traced a single time
+    and that graph runs every batch size. With a bucket scheme (see
+    `bucket_rows`) the batches are padded up to their bucket, so there's
+    one trace, with a fixed shape, for each bucket rather than for each
+    batch size. The padded rows are empty windows and they are dropped
+    from the outputs, so they never count toward the scores.
+
+    The inputs are windows of vocabulary indices, they are one-hot encoded
+    in a buffer reused by each thread between calls.
+
+    The output layer must be a Dense layer, its logits are returned along
+    with the probabilities.
+
+    `identity` identifies the weights of the model, i.e. for caching.
+    `traces` counts the times the function has been traced.
+    """
+
+    def __init__(self, model, identity: str = None, buckets: str = "none"):
+        import tensorflow as tf
+
+        self.keras_model = model
+        self.identity = identity or f"{model.name}:{id(model)}"
+        self.x_features = int(model.input_shape[1])
+        self.input_shape = (None, self.x_features, ONE_HOT_SIZE)
+        self.buckets = buckets
+        self.traces = 0
+
+        self._buffers = threading.local()
+        self._bucket_functions = {}
+
+        def forward(x):
+            # Only runs while tracing
+            self.traces += 1
+
+            hidden = x
+            for layer in model.layers[:-1]:
+                hidden = layer(hidden, training=False)
+
+            output = model.layers[-1]
+            logits = tf.nn.bias_add(tf.matmul(hidden, output.kernel),
+                                    output.bias)
+
+            return logits, output.activation(logits)
+
+        if buckets == "none":
+            self._forward = tf.function(
+                forward,
+                input_signature=[tf.TensorSpec(self.input_shape, tf.float32)]
+            )
+        else:
+            self._forward = tf.function(forward)
+
+    def predict(self, windows: np.ndarray) -> np.ndarray:
+        """Next character probabilities for each window"""
+        return self.predict_logits(windows)[1]
+
+    def predict_logits(self, windows: np.ndarray):
+        """Logits and next character probabilities for each window"""
+        rows = len(windows)
+        size = bucket_rows(rows, self.buckets)
+
+        logits, predictions = self._function(size)(
+            self._one_hot(windows, size)
+        )
+
+        return logits.numpy()[:rows], predictions.numpy()[:rows]
+
+    def _function(self, size: int):
+        if self.buckets == "none":
+            return self._forward
+
+        function = self._bucket_functions.get(size)
+        if function is None:
+            import tensorflow as tf
+
+            function = self._bucket_functions[size] = \
+                self._forward.get_concrete_function(
+                    tf.TensorSpec((size, self.x_features, ONE_HOT_SIZE),
+                                  tf.float32)
+                )
+
+        return function
+
+    def _one_hot(self, windows: np.ndarray, size: int) -> np.ndarray:
+        rows = len(windows)
+
+        buffer = getattr(self._buffers, "x", None)
+        if buffer is None or len(buffer) < size:
+            buffer = self._buffers.x = np.zeros(
+                (max(size, 2 * len(buffer) if buffer is not None else 256),
+                 self.x_features,
+                 ONE_HOT_SIZE),
+                dtype=np.float32
+            )
+
+        one_hot_windows(windows, out=buffer)
+        buffer[rows:size].fill(0)
+
+        return buffer[:size]
+
+
+def hard_sigmoid(x: np.ndarray) -> np.ndarray:
+    # As Keras 2 does
+    x = x * np.float32(0.2)
+    x += np.float32(0.5)
+
+    return np.clip(x, 0, 1, out=x)
+
+
+def softmax(x: np.ndarray) -> np.ndarray:
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "tanh": np.tanh,
+    "relu": lambda x: np.maximum(x, 0),
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+    "hard_sigmoid": hard_sigmoid,
+    "softmax": softmax,
+}
+
+
+def model_layers(model_config: dict) -> list:
+    """Layers config of a Sequential model, from Keras 2.1 and newer"""
+    config = model_config["config"]
+    if isinstance(config, dict):
+        config = config["layers"]
+
+    return [
+        layer for layer in config
+        if layer["class_name"] not in ("InputLayer", "Dropout")
+    ]
+
+
+def activation(name: str):
+    try:
+        return ACTIVATIONS[name]
+    except KeyError:
+        raise WAFBrainException(f"Unsupported activation: {name}")
+
+
+class NumPyEngine:
+    """
+    Forward pass of the GRU models in NumPy, without TensorFlow.
+
+    The models are a GRU layer over the one-hot encoded windows followed by
+    Dense layers. Multiplying a one-hot row by the GRU kernel is picking a
+    row of it, so the inputs of each step are gathered from the kernel by
+    the window indices. The GRU follows Keras 2 semantics: gates in z, r,
+    h order, `reset_after=False` and its hard sigmoid.
+
+    Build it with `from_h5` or `from_bundle`. Same interface and results,
+    within float32 rounding, as KerasEngine.
+
+    The weights aren't copied: the memory mapped weights of a bundle are
+    shared, read-only, by all the processes that load it.
+    """
+
+    def __init__(self,
+                 layers: list,
+                 weights: list,
+                 x_features: int,
+                 identity: str = None):
+        """
+        `layers` is the config of each layer of a Sequential model, and
+        `weights` the arrays of each one (in Keras order).
+        """
+        self.identity = identity or f"numpy:{id(self)}"
+        self.x_features = int(x_features)
+        self.input_shape = (None, self.x_features, ONE_HOT_SIZE)
+
+        if len(layers) != len(weights):
+            raise WAFBrainException("Model weights don't match its layers")
+
+        if not layers or layers[0]["class_name"] != "GRU" or \
+                layers[-1]["class_name"] != "Dense":
+            raise WAFBrainException(
+                "Only GRU layers followed by Dense layers are supported"
+            )
+
+        self.gru = self._gru_layer(layers[0]["config"], weights[0])
+        self.dense = [
+            self._dense_layer(layer, layer_weights)
+            for layer, layer_weights in zip(layers[1:], weights[1:])
+        ]
+
+    @staticmethod
+    def _gru_layer(config: dict, weights: list) -> dict:
+        if config.get("reset_after") or config.get("return_sequences") or \
+                config.get("go_backwards"):
+            raise WAFBrainException(
+                "Only GRU layers with reset_after, return_sequences and "
+                "go_backwards disabled are supported"
+            )
+
+        kernel, recurrent_kernel = [
+            np.asarray(w, dtype=np.float32) for w in weights[:2]
+        ]
+        units = recurrent_kernel.shape[0]
+        bias = np.asarray(weights[2], dtype=np.float32) \
+            if config.get("use_bias", True) else 0
+
+        return {
+            "units": units,
+            "kernel": kernel,
+            "bias": bias,
+            "recurrent_zr": recurrent_kernel[:, :2 * units],
+            "recurrent_h": recurrent_kernel[:, 2 * units:],
+            "activation": activation(config.get("activation", "tanh")),
+            "recurrent_activation": activation(
+                config.get("recurrent_activation", "hard_sigmoid")
+            ),
+        }
+
+    @staticmethod
+    def _dense_layer(layer: dict, weights: list) -> dict:
+        if layer["class_name"] != "Dense":
+            raise WAFBrainException(
+                f"Unsupported layer: {layer['class_name']}"
+            )
+
+        config = layer["config"]
+
+        return {
+            "kernel": np.asarray(weights[0], dtype=np.float32),
+            "bias": np.asarray(weights[1], dtype=np.float32)
+            if config.get("use_bias", True) else 0,
+            "activation": activation(config.get("activation", "linear")),
+        }
+
+    @classmethod
+    def from_h5(cls, path: str, identity: str = None):
+        """Read the config and the weights of a Keras .h5 model"""
+        with h5py.File(path, "r") as f:
+            layers = model_layers(json.loads(f.attrs["model_config"]))
+            model_weights = f["model_weights"]
+
+            weights = []
+            for layer in layers:
+                group = model_weights[layer["config"]["name"]]
+                weights.append([
+                    group[name][()] for name in group.attrs["weight_names"]
+                ])
+
+        return cls(layers,
+                   weights,
+                   layers[0]["config"]["batch_input_shape"][1],
+                   identity)
+
+    @classmethod
+    def from_bundle(cls, path: str):
+        """Read a bundle from `waf-models compile`"""
+        from waf_brain.bundles import read_manifest, load_bundle_weights
+
+        manifest = read_manifest(path)
+        layers = model_layers(json.loads(manifest["config"]))
+        arrays = [array for _, array in load_bundle_weights(path)]
+
+        # Weights are sorted by layer: GRU and Dense ones have a kernel and
+        # a bias, and GRU ones a recurrent kernel too
+        weights = []
+        for layer in layers:
+            config = layer["config"]
+            count = (3 if layer["class_name"] == "GRU" else 2) - \
+                (not config.get("use_bias", True))
+            weights.append(arrays[:count])
+            arrays = arrays[count:]
+
+        return cls(layers,
+                   weights,
+                   manifest["x_features"],
+                   manifest["identity"])
+
+    def predict(self, windows: np.ndarray) -> np.ndarray:
+        """Next character probabilities for each window"""
+        return self.predict_logits(windows)[1]
+
+    def predict_logits(self, windows: np.ndarray):
+        """Logits and next character probabilities for each window"""
+        hidden = self._forward_gru(np.asarray(windows))
+
+        for layer in self.dense[:-1]:
+            hidden = layer["activation"](hidden @ layer["kernel"] +
+                                         layer["bias"])
+
+        output = self.dense[-1]
+        logits = hidden @ output["kernel"] + output["bias"]
+
+        return logits, output["activation"](logits)
+
+    def _forward_gru(self, windows: np.ndarray) -> np.ndarray:
+        gru = self.gru
+        units = gru["units"]
+
+        # The state starts at zero: the first step has nothing to multiply
+        inputs = gru["kernel"][windows[:, 0]]
+        inputs += gru["bias"]
+        z = gru["recurrent_activation"](inputs[:, :units])
+        h = (1 - z) * gru["activation"](inputs[:, 2 * units:])
+
+        for t in range(1, windows.shape[1]):
+            inputs = gru["kernel"][windows[:, t]]
+            inputs += gru["bias"]
+
+            zr = inputs[:, :2 * units]
+            zr += h @ gru["recurrent_zr"]
+            zr = gru["recurrent_activation"](zr)
+            z, r = zr[:, :units], zr[:, units:]
+
+            candidate = inputs[:, 2 * units:]
+            candidate += (r * h) @ gru["recurrent_h"]
+            candidate = gru["activation"](candidate)
+
+            # h = z * h + (1 - z) * candidate
+            h -= candidate
+            h *= z
+            h += candidate
+
+        return h
+
+
+ENGINES = ("keras", "numpy")
+
+__all__ = ("KerasEngine", "NumPyEngine", "ENGINES", "BUCKET_SCHEMES",
+           "bucket_rows")
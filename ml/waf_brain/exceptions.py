@@ -2,4 +2,8 @@ class WAFBrainException(Exception):
     pass
 
 
-__all__ = ("WAFBrainException",)
+class InferenceQueueFull(WAFBrainException):
+    pass
+
+
+__all__ = ("WAFBrainException", "InferenceQueueFull")
@@ -1,5 +1,11 @@
 
 
+import os
+import random
+import logging
+import resource
+
+
 def get_log_level(level: int) -> int:
 
     # If quiet mode selected -> decrease log level
@@ -11,4 +17,35 @@ def get_log_level(level: int) -> int:
     return 60 - input_level
 
 
-__all__ = ("get_log_level", )
+def sample_debug(logger: logging.Logger, rate: float) -> bool:
+    """
+    Whether to log a debug message, `rate` of the times. Cheap enough to
+    be checked for every request before formatting the message.
+    """
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < rate
+
+
+def memory_usage() -> dict:
+    """
+    Resident memory of this process, in bytes: the total, the private
+    (anonymous) part and the file backed part, that includes memory mapped
+    model weights shared with other processes.
+    """
+    usage = {"pid": os.getpid()}
+
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "RssAnon", "RssFile", "RssShmem"):
+                    usage[name.lower()] = int(value.split()[0]) * 1024
+    except OSError:
+        # Not Linux, only the peak is known
+        usage["max_rss"] = resource.getrusage(
+            resource.RUSAGE_SELF
+        ).ru_maxrss * 1024
+
+    return usage
+
+
+__all__ = ("get_log_level", "sample_debug", "memory_usage")
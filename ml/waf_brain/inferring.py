@@ -1,7 +1,10 @@
 import time
 import string
+import logging
 import numpy as np
 
+log = logging.getLogger("waf-brain")
+
 X_FEATURES = 5
 BATCH_SIZE = 100000
 EPOCHS = 200
@@ -11,94 +14,335 @@ TEST_PERC = 0.05
 VOCABULARY = string.printable
 
 
-def row_parse(row):
-    def char_parse(char):
-        return VOCABULARY.index(char)
+# Index used for padding: "no character before/after this position"
+PAD_INDEX = len(VOCABULARY)
+ONE_HOT_SIZE = PAD_INDEX + 1
 
-    return [char_parse(char) for char in row]
+# Byte -> vocabulary index. Bytes out of the vocabulary are marked with -1
+CHAR_LOOKUP = np.full(256, -1, dtype=np.int64)
+CHAR_LOOKUP[np.frombuffer(VOCABULARY.encode("ascii"), dtype=np.uint8)] = \
+    np.arange(len(VOCABULARY))
 
+# Substrings usual in injections, used to guess which payloads to score first
+SUSPICIOUS_TOKENS = ("'", '"', "--", "/*", "#", "=", ";", "(", "<", ">", "|",
+                     "`")
 
-def reduce_dimension(row, x_features):
-    def create_new_row(index, char):
-        past_pos = x_features - 1
-        new_row = [None for i in range(x_features + 1)]
 
-        def fill_past():
-            if index > past_pos:
-                for i in range(past_pos * -1, 0, 1):
-                    pos = index - i
-                    if pos:
-                        new_row[past_pos + i] = row[index + i]
-            else:
-                for i in range(x_features, 0, -1):
-                    if (index - i) >= 0:
-                        x = (index - i) + 1
-                        new_row[past_pos - x] = row[index - x]
+def encode_payload(payload: str) -> np.ndarray:
+    """Map each character of the payload to its index in the vocabulary"""
+    try:
+        raw = payload.encode("latin-1")
+    except UnicodeEncodeError:
+        raise ValueError("payload contains characters out of the vocabulary")
 
-        def fill_future():
-            if (index + 1) < len(row):
-                new_row[-1] = row[index + 1]
+    codes = CHAR_LOOKUP[np.frombuffer(raw, dtype=np.uint8)]
 
-        fill_past()
-        new_row[past_pos] = char
-        fill_future()
-        return new_row
+    if (codes < 0).any():
+        raise ValueError("payload contains characters out of the vocabulary")
 
-    return [create_new_row(index, char) for index, char in enumerate(row)]
+    return codes
 
 
-def split_row(x, y, row):
+def window_indices(codes: np.ndarray, x_features: int = X_FEATURES):
+    """
+    Build the sliding windows of the payload, as vocabulary indices.
 
-    for t in row:
-        x_zeros = np.zeros((X_FEATURES, 101))
-        y_zeros = np.zeros((101))
+    For each character, the window holds the character and the
+    `x_features - 1` previous ones (left padded with PAD_INDEX) and the
+    target is the next character (PAD_INDEX at the end of the payload).
 
-        get_index = lambda index: 100 if index is None else index
+    Returns a tuple of arrays with shapes (n, x_features) and (n,). An
+    empty payload has no windows, its score is 0.
+    """
+    if not len(codes):
+        return np.empty((0, x_features), dtype=np.int64), \
+            np.empty(0, dtype=np.int64)
 
-        for i in range(X_FEATURES):
-            x_zeros[i][get_index(t[i])] = 1
+    padded = np.empty(len(codes) + x_features, dtype=np.int64)
+    padded[:x_features - 1] = PAD_INDEX
+    padded[x_features - 1:-1] = codes
+    padded[-1] = PAD_INDEX
 
-        x.append(x_zeros)
-        y_zeros[get_index(t[-1])] = 1
-        y.append(y_zeros)
+    windows = np.lib.stride_tricks.sliding_window_view(
+        padded[:-1], x_features
+    )
 
+    return windows, padded[x_features:]
 
-def to_ascii(row):
-    for i, elem in enumerate(row):
-        if elem == 1:
-            return VOCABULARY[i]
 
+def one_hot_windows(windows: np.ndarray,
+                    dtype=np.float32,
+                    out: np.ndarray = None) -> np.ndarray:
+    """
+    One-hot encode windows. If `out` is given it's used as the buffer for
+    the tensor, it must be big enough to hold them.
+    """
+    rows, x_features = windows.shape
 
-def transform_predict(y_predict):
-    index = np.argmax(y_predict)
-    if index == 100:
-        return None
-    return VOCABULARY[index]
+    if out is None:
+        x = np.zeros((rows, x_features, ONE_HOT_SIZE), dtype=dtype)
+    else:
+        x = out[:rows]
+        x.fill(0)
 
+    x[np.arange(rows)[:, None], np.arange(x_features), windows] = 1
 
-def build_text(predict_char, predict_texts):
-    if predict_char is None:
-        predict_texts.append([])
-    else:
-        predict_texts[-1].append(predict_char)
+    return x
+
+
+def one_hot(windows: np.ndarray,
+            targets: np.ndarray,
+            dtype=np.float64,
+            out: np.ndarray = None):
+    """One-hot encode windows and targets, see `one_hot_windows`"""
+    x = one_hot_windows(windows, dtype=dtype, out=out)
+    rows = len(windows)
+
+    y = np.zeros((rows, ONE_HOT_SIZE), dtype=x.dtype)
+    y[np.arange(rows), targets] = 1
+
+    return x, y
+
+
+def featurize(payload: str, x_features: int = X_FEATURES, dtype=np.float64):
+    """Build the (x, y) tensors of a payload for a model"""
+    windows, targets = window_indices(encode_payload(payload), x_features)
 
+    return one_hot(windows, targets, dtype=dtype)
 
-def process_payload(model, param_name, payloads, check_weights=False):
+
+def model_features(model) -> int:
+    """Number of characters of the input window used by the model"""
+    if getattr(model, "x_features", None):
+        return model.x_features
+
+    try:
+        return int(model.input_shape[1])
+    except (AttributeError, TypeError, IndexError):
+        return X_FEATURES
+
+
+def accuracy_scores(predictions: np.ndarray, targets: np.ndarray, sizes):
+    """
+    Score each payload of a concatenated batch: the ratio of characters
+    whose next character was right predicted by the model. It matches the
+    Keras `accuracy` metric, reduced in float32 as Keras does.
+
+    `sizes` is the number of consecutive windows of each payload.
+    """
+    hits = (np.argmax(predictions, axis=-1) == targets).astype(np.float32)
+    sizes = np.asarray(sizes)
+
+    offsets = np.zeros(len(sizes), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=offsets[1:])
+
+    totals = np.zeros(len(sizes), dtype=np.float32)
+    not_empty = sizes > 0
+    if len(hits):
+        totals[not_empty] = np.add.reduceat(hits, offsets[not_empty])
+
+    return [
+        float(total / np.float32(size)) if size else 0.0
+        for total, size in zip(totals, sizes)
+    ]
+
+
+def score_payload(model, payload: str):
+    """
+    Score a payload with one forward pass of the model (an engine from
+    `waf_brain.engines`). Returns the score and the model predictions.
+    """
+    windows, targets = window_indices(encode_payload(payload),
+                                      model_features(model))
+
+    predictions = model.predict(windows)
+
+    return accuracy_scores(predictions, targets, [len(targets)])[0], \
+        predictions
+
+
+def score_payloads(model, payloads: list) -> list:
+    """
+    Score several payloads with one forward pass of the model. Payloads
+    with characters out of the vocabulary get None.
+    """
+    x_features = model_features(model)
+    scores = [None] * len(payloads)
+
+    scorable, windows, targets = [], [], []
+    for i, payload in enumerate(payloads):
+        try:
+            payload_windows, payload_targets = window_indices(
+                encode_payload(payload), x_features
+            )
+        except ValueError:
+            continue
+
+        scorable.append(i)
+        windows.append(payload_windows)
+        targets.append(payload_targets)
+
+    if not scorable:
+        return scores
+
+    predictions = model.predict(np.concatenate(windows))
+
+    for i, score in zip(scorable,
+                        accuracy_scores(predictions,
+                                        np.concatenate(targets),
+                                        [len(t) for t in targets])):
+        scores[i] = score
+
+    return scores
+
+
+def unscorable_verdict(param_name: str, diff_time: float = 0.0) -> dict:
+    """
+    Verdict of a parameter that can't be scored, with characters out of
+    the vocabulary. See `is_dangerous`.
+    """
+    return {
+        "paramName": param_name,
+        "score": None,
+        "unscorable": True,
+        "time": diff_time
+    }
+
+
+def is_dangerous(result: dict, threshold: float) -> bool:
+    """
+    Whether a scored parameter must be blocked: its score reaches the
+    threshold or it couldn't be scored, so nothing says it's safe.
+    """
+    return result.get("unscorable", False) or result["score"] >= threshold
+
+
+def suspicion(payload: str) -> tuple:
+    """
+    Cheap guess of how dangerous a payload looks, without the model: the
+    suspicious tokens it has and then its length.
+    """
+    return (sum(payload.count(token) for token in SUSPICIOUS_TOKENS),
+            len(payload))
+
+
+def request_params(query_args, form=(), cookies=(), headers=()) -> list:
+    """
+    Gather the (name, value) pairs of a request that must be scored.
+    Parameters that don't come from the query string are prefixed with
+    their origin.
+    """
+    return [
+        *((name, value) for name, value in query_args),
+        *((f"body:{name}", value) for name, value in form),
+        *((f"cookie:{name}", value) for name, value in cookies),
+        *((f"header:{name}", value) for name, value in headers),
+    ]
+
+
+def process_request(model, params: list) -> list:
+    """
+    Score all the (name, value) parameters of a request with one forward
+    pass of the model. Parameters that can't be scored get an
+    `unscorable_verdict`.
+    """
+    before_time = time.time()
+    scores = score_payloads(model, [value for _, value in params])
+
+    # Inference time
+    diff_time = time.time() - before_time
+
+    return [
+        {
+            "paramName": name,
+            "score": score,
+            "time": diff_time
+        } if score is not None else unscorable_verdict(name, diff_time)
+        for (name, _), score in zip(params, scores)
+    ]
+
+
+def window_losses(logits: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    Categorical cross-entropy of each window. As Keras does for softmax
+    outputs, it's computed from the logits.
+    """
+    logits = np.asarray(logits, dtype=np.float32)
+    top = logits.max(axis=-1)
+    log_sum = top + np.log(np.exp(logits - top[:, None]).sum(axis=-1))
+
+    return log_sum - logits[np.arange(len(targets)), targets]
+
+
+def occlusion_weights(model,
+                      windows: np.ndarray,
+                      targets: np.ndarray,
+                      predictions: np.ndarray) -> np.ndarray:
+    """
+    Influence of each character in the score: how much the score drops
+    when the character is replaced by the padding index.
+
+    Only the windows that contain the occluded character change, so the
+    windows of all the occluded variants are scored in one model call.
+    """
+    rows, x_features = windows.shape
+    if not rows:
+        return np.zeros(0)
+
+    hits = np.argmax(predictions, axis=-1) == targets
+
+    # Variant `i` changes the windows i .. i + x_features - 1. In window
+    # i + k the occluded character is at column x_features - 1 - k
+    occluded = np.repeat(np.arange(rows), x_features)
+    shift = np.tile(np.arange(x_features), rows)
+    keep = occluded + shift < rows
+    occluded, shift = occluded[keep], shift[keep]
+    changed = occluded + shift
+
+    variant_windows = windows[changed]
+    variant_windows[np.arange(len(changed)), x_features - 1 - shift] = \
+        PAD_INDEX
+
+    variant_hits = np.argmax(model.predict(variant_windows), axis=-1) == \
+        targets[changed]
+
+    lost_hits = np.bincount(
+        occluded,
+        weights=hits[changed].astype(np.int64) - variant_hits,
+        minlength=rows
+    )
+
+    # The window before the occluded character must predict it
+    lost_hits[1:] += hits[:-1].astype(np.int64) - \
+        (np.argmax(predictions[:-1], axis=-1) == PAD_INDEX)
+
+    return lost_hits / rows
+
+
+def process_payload(model,
+                    param_name,
+                    payloads,
+                    check_weights=False,
+                    occlusion=False):
     try:
         # Snapshot for time
         before_time = time.time()
-        elems = [reduce_dimension(row_parse(payloads[0]), X_FEATURES)]
-        print(payloads[0], elems)
-        x_demo = []
-        y_demo = []
+        try:
+            codes = encode_payload(payloads[0])
+        except ValueError:
+            return {
+                **unscorable_verdict(param_name, time.time() - before_time),
+                "weights": []
+            }
 
-        # Passing a value
-        for elem in elems:
-            split_row(x_demo, y_demo, elem)
+        windows, targets = window_indices(codes, model_features(model))
+
+        if check_weights:
+            logits, predictions = model.predict_logits(windows)
+        else:
+            predictions = model.predict(windows)
 
-        nn_score = [model.evaluate(np.array(x_demo),
-                                   np.array(y_demo),
-                                   verbose=0)][0][1]
+        nn_score = accuracy_scores(predictions, targets, [len(targets)])[0]
 
         # Inference time
         diff_time = time.time() - before_time
@@ -108,42 +352,37 @@ def process_payload(model, param_name, payloads, check_weights=False):
         # ---------------------------------------------------------------------
         weights = []
         if check_weights:
+            losses = window_losses(logits, targets)
+            hits = np.argmax(predictions, axis=-1) == targets
 
-            predict_chars = [
-                transform_predict(y_predict)
-                for y_predict in model.predict(np.array(x_demo))
-            ]
-            predict_texts = [[]]
-
-            for predict_char in predict_chars:
-                build_text(predict_char, predict_texts)
-
-            odor = [[payloads[0][i],
-                     model.evaluate(np.expand_dims(x_demo[i], axis=0),
-                                    np.expand_dims(y_demo[i], axis=0),
-                                    batch_size=BATCH_SIZE,
-                                    verbose=0)] for i in range(len(payloads[0]))]
             weights = [
                 {
-                    "letter": o[0],
-                    "weight": o[1][0],
-                    "szie": o[1][1],
+                    "letter": letter,
+                    "weight": float(loss),
+                    "szie": float(hit),
                 }
-                for o in odor
+                for letter, loss, hit in zip(payloads[0], losses, hits)
             ]
 
+            if occlusion:
+                for weight, influence in zip(
+                        weights,
+                        occlusion_weights(model, windows, targets, predictions)
+                ):
+                    weight["occlusion"] = float(influence)
+
         return {
             "paramName": param_name,
             "score": nn_score,
             "time": diff_time,
             "weights": weights
         }
-
-        # with open('outputAttacks/sqlattacksOutput_feat_5_botneck-101_demo.txt', 'a') as file:
-        #     file.write('{}\t{}\t{}\t{}\n'.format(nn_score[0][1], diff_time, payloads[0], odor))
-    except Exception as e:
-        # print(e.with_traceback(), file=sys.stderr)
-        print(e)
+    except Exception:
+        log.exception(f"can't process param '{param_name}'")
 
 
-__all__ = ("process_payload", )
+__all__ = ("process_payload", "process_request", "request_params",
+           "score_payload", "score_payloads", "unscorable_verdict",
+           "is_dangerous", "suspicion", "featurize",
+           "one_hot_windows", "accuracy_scores", "window_losses",
+           "occlusion_weights")
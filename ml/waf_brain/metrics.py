@@ -0,0 +1,145 @@
+from bisect import bisect_left
+from collections import defaultdict
+
+# Upper bounds, in seconds, of the latency histograms buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Type and help of the metrics of the app
+METRICS = {
+    "stage_seconds": (
+        "histogram",
+        "Time spent in each stage: featurize, queue_wait, forward, "
+        "upstream and response"
+    ),
+    "request_seconds": (
+        "histogram",
+        "Time to answer a request, by outcome"
+    ),
+    "requests_total": (
+        "counter",
+        "Requests answered, by outcome"
+    ),
+    "errors_total": (
+        "counter",
+        "Errors, by kind"
+    ),
+}
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list:
+        """(upper bound, observations up to it) of each bucket"""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"), ),
+                                self.counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+
+class Metrics:
+    """
+    Histograms and counters of a worker, rendered in the Prometheus text
+    format.
+
+    Observing a value is a dict lookup, a bisect and a few additions, so
+    it can be done for every request. Metrics are identified by their
+    name, without the prefix, and their labels.
+    """
+
+    def __init__(self,
+                 prefix: str = "waf_brain",
+                 buckets: tuple = LATENCY_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+
+        self.histograms = defaultdict(dict)
+        self.counters = defaultdict(lambda: defaultdict(float))
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(labels.items())
+
+        histogram = self.histograms[name].get(key)
+        if histogram is None:
+            histogram = self.histograms[name][key] = Histogram(self.buckets)
+
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[name][tuple(labels.items())] += value
+
+    def render(self, extra: list = ()) -> str:
+        """
+        Metrics in the Prometheus text format. `extra` are the metrics
+        known when they are scraped, as (name, type, help, values) where
+        `values` is a list of (labels dict, value).
+        """
+        lines = []
+
+        for name, histograms in self.histograms.items():
+            lines.extend(self._header(name, *METRICS.get(name,
+                                                         ("histogram", ""))))
+
+            for key, histogram in histograms.items():
+                for bound, count in histogram.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(self._sample(f"{name}_bucket",
+                                              key + (("le", le), ),
+                                              count))
+                lines.append(self._sample(f"{name}_sum", key, histogram.sum))
+                lines.append(self._sample(f"{name}_count",
+                                          key,
+                                          histogram.count))
+
+        for name, counters in self.counters.items():
+            lines.extend(self._header(name, *METRICS.get(name,
+                                                         ("counter", ""))))
+            for key, value in counters.items():
+                lines.append(self._sample(name, key, value))
+
+        for name, kind, help_text, values in extra:
+            lines.extend(self._header(name, kind, help_text))
+            for labels, value in values:
+                lines.append(self._sample(name,
+                                          tuple(labels.items()),
+                                          value))
+
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name: str, kind: str, help_text: str) -> list:
+        return [
+            f"# HELP {self.prefix}_{name} {help_text}",
+            f"# TYPE {self.prefix}_{name} {kind}",
+        ]
+
+    def _sample(self, name: str, labels: tuple, value: float) -> str:
+        if labels:
+            escaped = ",".join(
+                f'{k}="{escape_label(v)}"' for k, v in labels
+            )
+            return f"{self.prefix}_{name}{{{escaped}}} {float(value)!r}"
+
+        return f"{self.prefix}_{name} {float(value)!r}"
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\") \
+        .replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+__all__ = ("Metrics", "Histogram", "LATENCY_BUCKETS")
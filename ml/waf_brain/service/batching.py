@@ -0,0 +1,276 @@
+import time
+import asyncio
+import logging
+
+from collections import deque
+
+import numpy as np
+
+from waf_brain.exceptions import InferenceQueueFull
+from waf_brain.inferring import (
+    encode_payload, window_indices, model_features, accuracy_scores
+)
+
+log = logging.getLogger("waf-brain")
+
+
+class InferenceBatcher:
+    """
+    Gather the windows of the payloads sent by all the concurrent requests
+    and score them with one forward pass of the model per tick.
+
+    A tick ends when `flush_size` windows are waiting or when the oldest
+    payload has been waiting for `max_wait` milliseconds, and scores no
+    more than `flush_size` windows, the rest wait for the next tick. The
+    forward pass runs in the `executor` (an InferenceExecutor) when it's
+    given, so there can be a batch in flight for each of its workers.
+
+    No more than `max_queue` payloads can wait for a batch, new ones
+    raise InferenceQueueFull. Once stopped, the payloads that still arrive
+    are scored right away.
+
+    `name` names the model in the stats. The featurize, queue_wait and
+    forward stages are timed in `metrics`, a Metrics, when it's given.
+    """
+
+    def __init__(self,
+                 model,
+                 flush_size: int = 2048,
+                 max_wait: float = 2,
+                 executor=None,
+                 max_queue: int = 1024,
+                 history: int = 10000,
+                 name: str = None,
+                 metrics=None):
+        self.model = model
+        self.name = name or model.identity
+        self.metrics = metrics
+        self.flush_size = int(flush_size)
+        self.max_wait = float(max_wait) / 1000
+        self.executor = executor
+        self.max_queue = int(max_queue)
+
+        self._pending = []
+        self._pending_rows = 0
+        self._arrived = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = None
+        self._stopped = False
+        self._flushing = set()
+        self._slots = asyncio.Semaphore(executor.workers if executor else 1)
+
+        self.batches = 0
+        self.payloads = 0
+        self.windows = 0
+        self.forward_time = 0.0
+        self.latencies = deque(maxlen=history)
+        self.batch_fill = deque(maxlen=history)
+
+    @property
+    def identity(self) -> str:
+        return self.model.identity
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._stopped = True
+
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        # Don't let anyone waiting forever
+        await self._flush_pending()
+        if self._flushing:
+            await asyncio.wait(self._flushing)
+
+    async def score(self, payload: str) -> float:
+        """Score a payload in the next batch"""
+        return (await self.score_many([payload], strict=True))[0]
+
+    async def score_many(self, payloads: list, strict: bool = False) -> list:
+        """
+        Score several payloads in the same batch. Payloads with characters
+        out of the vocabulary get None, or raise ValueError if `strict`.
+        """
+        if len(self._pending) + len(payloads) > self.max_queue:
+            raise InferenceQueueFull(
+                f"inference queue is full ({self.max_queue} payloads)"
+            )
+
+        before_time = time.perf_counter()
+
+        x_features = model_features(self.model)
+        futures = []
+        for payload in payloads:
+            try:
+                windows, targets = window_indices(encode_payload(payload),
+                                                  x_features)
+            except ValueError:
+                if strict:
+                    raise
+                futures.append(None)
+                continue
+
+            futures.append(self._enqueue(windows, targets))
+
+        if self.metrics:
+            self.metrics.observe("stage_seconds",
+                                 time.perf_counter() - before_time,
+                                 stage="featurize")
+
+        if self._stopped:
+            await self._flush_pending()
+
+        return [await f if f else None for f in futures]
+
+    def _enqueue(self, windows: np.ndarray, targets: np.ndarray):
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((windows, targets, future, time.perf_counter()))
+        self._pending_rows += len(windows)
+
+        self._arrived.set()
+        if self._pending_rows >= self.flush_size:
+            self._full.set()
+
+        return future
+
+    @property
+    def seconds_per_window(self):
+        """Mean model time to score a window, None until it's known"""
+        return self.forward_time / self.windows if self.windows else None
+
+    @property
+    def stats(self) -> dict:
+        latencies = np.asarray(self.latencies) * 1000
+        fill = np.asarray(self.batch_fill)
+
+        return {
+            "batches": self.batches,
+            "payloads": self.payloads,
+            "pending": len(self._pending),
+            "latency_p50_ms": float(np.percentile(latencies, 50))
+            if len(latencies) else 0.0,
+            "latency_p99_ms": float(np.percentile(latencies, 99))
+            if len(latencies) else 0.0,
+            "batch_fill": float(fill.mean()) if len(fill) else 0.0,
+            "windows": self.windows,
+            "forward_ms": self.forward_time * 1000,
+        }
+
+    def _take_pending(self) -> list:
+        """
+        Oldest pending payloads, up to `flush_size` windows. The windows of
+        a payload are never split, one bigger than that goes alone.
+        """
+        rows = taken = 0
+        for windows, _, _, _ in self._pending:
+            if taken and rows + len(windows) > self.flush_size:
+                break
+            rows += len(windows)
+            taken += 1
+
+        batch, self._pending = self._pending[:taken], self._pending[taken:]
+        self._pending_rows -= rows
+
+        if not self._pending:
+            self._arrived.clear()
+        if self._pending_rows < self.flush_size:
+            self._full.clear()
+
+        return batch
+
+    async def _flush_pending(self):
+        while self._pending:
+            await self._flush(self._take_pending())
+
+    async def _run(self):
+        while True:
+            await self._arrived.wait()
+
+            oldest = self._pending[0][3]
+            delay = oldest + self.max_wait - time.perf_counter()
+            if delay > 0 and not self._full.is_set():
+                try:
+                    await asyncio.wait_for(self._full.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+            # Wait for a free worker, meanwhile the batch keeps growing
+            await self._slots.acquire()
+
+            task = asyncio.ensure_future(self._flush(self._take_pending()))
+            self._flushing.add(task)
+            task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        self._flushing.discard(task)
+        self._slots.release()
+
+    def _forward(self, batch: list) -> tuple:
+        before_time = time.perf_counter()
+
+        sizes = [len(windows) for windows, _, _, _ in batch]
+        rows = sum(sizes)
+        if not rows:
+            return [0.0] * len(batch), 0.0
+
+        windows = np.concatenate([w for w, _, _, _ in batch])
+        targets = np.concatenate([t for _, t, _, _ in batch])
+
+        predictions = self.model.predict(windows)
+
+        return accuracy_scores(predictions, targets, sizes), \
+            time.perf_counter() - before_time
+
+    async def _flush(self, batch: list):
+        if not batch:
+            return
+
+        try:
+            if self.executor:
+                scores, elapsed = await self.executor.run(self._forward,
+                                                          batch)
+            else:
+                scores, elapsed = self._forward(batch)
+        except Exception as e:
+            log.exception("error scoring a batch")
+            if self.metrics:
+                self.metrics.inc("errors_total", kind="inference")
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        now = time.perf_counter()
+        for (_, _, future, enqueued), score in zip(batch, scores):
+            self.latencies.append(now - enqueued)
+            if not future.done():
+                future.set_result(score)
+
+            if self.metrics:
+                self.metrics.observe("stage_seconds",
+                                     max(now - enqueued - elapsed, 0),
+                                     stage="queue_wait")
+
+        if self.metrics:
+            self.metrics.observe("stage_seconds", elapsed, stage="forward")
+
+        rows = sum(len(w) for w, _, _, _ in batch)
+
+        self.batches += 1
+        self.payloads += len(batch)
+        self.windows += rows
+        self.forward_time += elapsed
+        self.batch_fill.append(min(rows / self.flush_size, 1.0))
+
+
+__all__ = ("InferenceBatcher", )
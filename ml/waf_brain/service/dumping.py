@@ -0,0 +1,204 @@
+import os
+import json
+import asyncio
+import logging
+
+log = logging.getLogger("waf-brain")
+
+DUMP_FORMATS = ("text", "jsonl")
+
+# Queued by stop(), after the last record
+_STOP = object()
+
+
+def format_text(record: dict) -> str:
+    return f"[sec: {record['time']:.5f}] param: '{record['paramName']}' " \
+        f"- Scoring: {record['score']} - " \
+        f"track-id:{record['trackId']}\n" \
+        f"{record['weights']}\n"
+
+
+def format_jsonl(record: dict) -> str:
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+class DumpWriter:
+    """
+    Append the records of the simulator to the dump file from a background
+    task, so requests don't open the file nor wait for it.
+
+    Records wait in a queue of `max_queue` records and are written together
+    once `flush_size` of them are waiting or the oldest one has waited for
+    `flush_interval` seconds. Formatting and writing run in a thread. When
+    the queue is full, new records are dropped and counted.
+
+    Formats are `text`, the lines the simulator has always written, and
+    `jsonl`, a JSON object per line.
+
+    When the file reaches `max_bytes` (0 never), it's renamed to `path.1`,
+    the previous `path.1` to `path.2` and so on, keeping `backups` files.
+    Workers sharing the file reopen it when another one has rotated it.
+    """
+
+    def __init__(self,
+                 path: str,
+                 fmt: str = "text",
+                 max_bytes: int = 0,
+                 backups: int = 5,
+                 max_queue: int = 10000,
+                 flush_size: int = 256,
+                 flush_interval: float = 1.0):
+        if fmt not in DUMP_FORMATS:
+            raise ValueError(f"Unknown dump format: {fmt}")
+
+        self.path = path
+        self.format = format_jsonl if fmt == "jsonl" else format_text
+        self.max_bytes = int(max_bytes)
+        self.backups = int(backups)
+        self.flush_size = int(flush_size)
+        self.flush_interval = float(flush_interval)
+
+        self._queue = asyncio.Queue(maxsize=int(max_queue))
+        self._full = asyncio.Event()
+        self._file = None
+        self._task = None
+        self._stopped = False
+
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.rotations = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Write the records still waiting and close the file"""
+        if self._task is None:
+            return
+
+        self._stopped = True
+        await self._queue.put(_STOP)
+        self._full.set()
+
+        await self._task
+        self._task = None
+
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def write(self, record: dict) -> bool:
+        """Queue a record, False if it had to be dropped"""
+        if self._stopped:
+            self.dropped += 1
+            return False
+
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                log.warning(f"dump queue is full, {self.dropped} records "
+                            f"dropped so far")
+            return False
+
+        if self._queue.qsize() >= self.flush_size:
+            self._full.set()
+
+        return True
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "pending": self._queue.qsize(),
+            "flushes": self.flushes,
+            "rotations": self.rotations,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            records = [await self._queue.get()]
+
+            if records[0] is not _STOP and \
+                    self._queue.qsize() + 1 < self.flush_size:
+                try:
+                    await asyncio.wait_for(self._full.wait(),
+                                           self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+
+            while not self._queue.empty():
+                records.append(self._queue.get_nowait())
+
+            stop = records[-1] is _STOP
+            if stop:
+                records.pop()
+
+            if records:
+                try:
+                    await loop.run_in_executor(None, self._write, records)
+                except Exception:
+                    log.exception(f"can't write {len(records)} records to "
+                                  f"the dump file")
+                    self.dropped += len(records)
+                else:
+                    self.written += len(records)
+                    self.flushes += 1
+
+            if stop:
+                return
+
+    def _write(self, records: list):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+
+        self._file.write("".join(self.format(r) for r in records))
+        self._file.flush()
+
+        if self.max_bytes:
+            self._rotate_if_needed()
+
+    def _rotate_if_needed(self):
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            current = None
+
+        # Rotated by another worker
+        if current is None or \
+                current.st_ino != os.fstat(self._file.fileno()).st_ino:
+            self._reopen()
+            return
+
+        if current.st_size < self.max_bytes:
+            return
+
+        self._file.close()
+        self._file = None
+
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+        self.rotations += 1
+        self._reopen()
+
+    def _reopen(self):
+        if self._file:
+            self._file.close()
+
+        self._file = open(self.path, "a", encoding="utf-8")
+
+
+__all__ = ("DumpWriter", "DUMP_FORMATS")
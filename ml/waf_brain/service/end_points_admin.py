@@ -0,0 +1,157 @@
+import hmac
+import logging
+
+from sanic import response, Blueprint
+from sanic.request import Request
+
+from waf_brain.exceptions import WAFBrainException
+from waf_brain.helpers import memory_usage
+from .reloading import reload_app
+
+log = logging.getLogger("waf-brain")
+
+admin_blueprint = Blueprint("waf_brain_admin")
+
+
+@admin_blueprint.route('/__health', methods=["GET"])
+async def health(request: Request):
+    STARTUP = request.app.config["STARTUP"]
+
+    return response.json(
+        {
+            "status": "ready" if STARTUP.ready else "starting",
+            "startup": STARTUP.phases
+        },
+        status=200 if STARTUP.ready else 503
+    )
+
+
+def is_admin(request: Request) -> bool:
+    ADMIN_TOKEN = request.app.config["ADMIN_TOKEN"]
+
+    # Without a token, only from this host
+    if not ADMIN_TOKEN:
+        return request.ip in ("127.0.0.1", "::1")
+
+    return hmac.compare_digest(request.headers.get("Authorization", ""),
+                               f"Bearer {ADMIN_TOKEN}")
+
+
+@admin_blueprint.route('/__reload', methods=["POST"])
+async def reload(request: Request):
+    if not is_admin(request):
+        return response.json({"error": "forbidden"}, status=403)
+
+    changes = request.json if request.body else {}
+    if not isinstance(changes, dict):
+        return response.json({"error": "expected a JSON object"},
+                             status=400)
+
+    try:
+        result = await reload_app(request.app, changes)
+    except WAFBrainException as e:
+        return response.json({"error": str(e)}, status=400)
+
+    return response.json(result)
+
+
+@admin_blueprint.route('/__stats', methods=["GET"])
+async def stats(request: Request):
+    if not is_admin(request):
+        return response.json({"error": "forbidden"}, status=403)
+
+    BATCHERS = request.app.config.get("BATCHERS")
+    SCORER = request.app.config.get("SCORER")
+    EXECUTOR = request.app.config.get("EXECUTOR")
+    VERDICT_CACHE = request.app.config.get("VERDICT_CACHE")
+    DUMP_WRITER = request.app.config.get("DUMP_WRITER")
+
+    return response.json({
+        "memory": memory_usage(),
+        "batching": {
+            batcher.name: batcher.stats for batcher in BATCHERS
+        } if BATCHERS else None,
+        "scoring": SCORER.stats
+        if SCORER and SCORER not in BATCHERS else None,
+        "inference": {
+            "workers": EXECUTOR.workers,
+            "in_flight": EXECUTOR.in_flight
+        } if EXECUTOR else None,
+        "cache": VERDICT_CACHE.stats if VERDICT_CACHE else None,
+        "dump": DUMP_WRITER.stats if DUMP_WRITER else None
+    })
+
+
+async def metrics(request: Request):
+    """
+    Metrics of this worker in the Prometheus text format. Its path is set
+    by --metrics-path, so it can't hide a path of the protected app.
+    """
+    METRICS = request.app.config["METRICS"]
+    BATCHERS = request.app.config.get("BATCHERS") or []
+    EXECUTOR = request.app.config.get("EXECUTOR")
+    VERDICT_CACHE = request.app.config.get("VERDICT_CACHE")
+    STARTUP = request.app.config["STARTUP"]
+    DUMP_WRITER = request.app.config.get("DUMP_WRITER")
+
+    memory = memory_usage()
+
+    extra = [
+        ("ready", "gauge", "Whether the worker has warmed up the models",
+         [({}, STARTUP.ready)]),
+        ("memory_rss_bytes", "gauge", "Resident memory of the worker",
+         [({}, memory.get("vmrss", memory.get("max_rss", 0)))]),
+    ]
+
+    if BATCHERS:
+        extra.extend(
+            (name, kind, help_text, [
+                ({"model": b.name}, value(b)) for b in BATCHERS
+            ])
+            for name, kind, help_text, value in (
+                ("batches_total", "counter", "Model calls",
+                 lambda b: b.batches),
+                ("payloads_total", "counter", "Payloads scored",
+                 lambda b: b.payloads),
+                ("windows_total", "counter", "Windows scored",
+                 lambda b: b.windows),
+                ("pending_payloads", "gauge", "Payloads waiting for a batch",
+                 lambda b: len(b._pending)),
+            )
+        )
+
+    if EXECUTOR:
+        extra.append(("inference_in_flight", "gauge",
+                      "Batches running in the inference workers",
+                      [({}, EXECUTOR.in_flight)]))
+
+    if VERDICT_CACHE:
+        cache = VERDICT_CACHE.stats
+        extra.extend([
+            ("cache_hits_total", "counter", "Verdicts found in the cache",
+             [({}, cache["hits"])]),
+            ("cache_misses_total", "counter", "Verdicts not in the cache",
+             [({}, cache["misses"])]),
+            ("cache_evictions_total", "counter",
+             "Verdicts evicted from the cache",
+             [({}, cache["evictions"])]),
+            ("cache_size", "gauge", "Verdicts in the cache",
+             [({}, cache["size"])]),
+        ])
+
+    if DUMP_WRITER:
+        dump = DUMP_WRITER.stats
+        extra.extend([
+            ("dump_records_total", "counter",
+             "Records written to the dump file",
+             [({}, dump["written"])]),
+            ("dump_records_dropped_total", "counter",
+             "Records dropped because the dump queue was full",
+             [({}, dump["dropped"])]),
+        ])
+
+    return response.text(METRICS.render(extra),
+                         content_type="text/plain; version=0.0.4")
+
+
+__all__ = ("admin_blueprint", "metrics")
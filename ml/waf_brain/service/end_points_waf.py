@@ -1,16 +1,225 @@
-import aiofiles
-import aiohttp
+import time
+import asyncio
 import logging
 
+import aiohttp
+
 from sanic import response, Blueprint
+from sanic.helpers import has_message_body
 from sanic.request import Request
 
-from waf_brain.inferring import process_payload
+from waf_brain.helpers import sample_debug
+from waf_brain.inferring import (
+    request_params, suspicion, is_dangerous, unscorable_verdict
+)
 
 log = logging.getLogger("waf-brain")
 
 waf_blueprint = Blueprint("waf_brain")
 
+# Headers that only make sense for a single connection
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+}
+
+# Bodies whose fields are scored
+FORM_CONTENT_TYPES = {
+    "application/x-www-form-urlencoded",
+    "multipart/form-data",
+}
+
+
+async def score_params(scorer, cache, params: list) -> list:
+    """
+    Score all the (name, value) parameters of a request in the same batch,
+    with an InferenceBatcher or a scorer of several models. Parameters that
+    can't be scored, with characters out of the vocabulary, get an
+    `unscorable` verdict instead of a score.
+    """
+    model_id = scorer.identity
+
+    if cache:
+        verdicts = await cache.get_many(model_id,
+                                        "score",
+                                        [payload for _, payload in params])
+    else:
+        verdicts = [None] * len(params)
+
+    missing = [i for i, verdict in enumerate(verdicts) if verdict is None]
+    if missing:
+        before_time = time.time()
+
+        scores = await scorer.score_many([params[i][1] for i in missing])
+
+        diff_time = time.time() - before_time
+
+        for i, score in zip(missing, scores):
+            param_name, payload = params[i]
+
+            if score is None:
+                log.warning(f"can't score param '{param_name}': characters "
+                            f"out of the vocabulary, it's dangerous")
+                verdicts[i] = unscorable_verdict(param_name, diff_time)
+                continue
+
+            verdicts[i] = {
+                "score": score,
+                "time": diff_time
+            }
+
+            if cache:
+                cache.set(model_id, "score", payload, verdicts[i])
+
+    return [
+        {
+            "paramName": param_name,
+            **verdict
+        }
+        for (param_name, _), verdict in zip(params, verdicts)
+    ]
+
+
+async def score_until_blocked(scorer,
+                              cache,
+                              params: list,
+                              threshold: float) -> tuple:
+    """
+    Score the most suspicious parameters first, in stages of 1, 2, 4...
+    parameters, until one of them is dangerous.
+
+    Returns the results and the parameters that weren't scored.
+    """
+    params = sorted(params, key=lambda p: suspicion(p[1]), reverse=True)
+
+    total = []
+    start, stage = 0, 1
+    while start < len(params):
+        results = await score_params(scorer,
+                                     cache,
+                                     params[start:start + stage])
+        total.extend(results)
+        start += stage
+        stage *= 2
+
+        if any(is_dangerous(x, threshold) for x in results):
+            return total, params[start:]
+
+    return total, []
+
+
+async def stream_request_body(request: Request):
+    while True:
+        chunk = await request.stream.read()
+        if chunk is None:
+            break
+
+        yield chunk
+
+
+async def discard_request_body(request: Request):
+    async for _ in stream_request_body(request):
+        pass
+
+
+class UpstreamResponse(aiohttp.ClientResponse):
+    """
+    Response of the upstream. aiohttp gives the connection back to the pool
+    as soon as the response ends. If the request body is still being sent
+    then, the connection is half-written: it's closed instead.
+    """
+
+    def _response_eof(self):
+        if self._writer is not None and not self._writer.done() and \
+                self._connection is not None and \
+                self._connection.protocol is not None:
+            self._connection.protocol.force_close()
+
+        super()._response_eof()
+
+
+class StreamedBody:
+    """
+    Request body streamed to the upstream. `sent` tells whether it was sent
+    whole: the upstream can answer before reading all of it, i.e. a 413.
+    """
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.sent = False
+
+    async def __aiter__(self):
+        async for chunk in stream_request_body(self.request):
+            yield chunk
+
+        self.sent = True
+
+
+async def release_upstream(request: Request, resp, body):
+    """
+    Give the upstream connection back to the pool. If the upstream answered
+    before the whole request body was sent, the connection is half-written
+    and can't be reused: it's closed, and the rest of the body is read.
+    """
+    if isinstance(body, StreamedBody) and not body.sent:
+        resp.close()
+        await discard_request_body(request)
+    else:
+        resp.release()
+
+
+async def read_request_body(request: Request, limit: int):
+    """Whole request body, or None if it's bigger than `limit` bytes"""
+    body = bytearray()
+
+    while True:
+        chunk = await request.stream.read()
+        if chunk is None:
+            return bytes(body)
+
+        body += chunk
+        if len(body) > limit:
+            return None
+
+
+def answered(metrics, started: float, outcome: str):
+    metrics.inc("requests_total", outcome=outcome)
+    metrics.observe("request_seconds",
+                    time.perf_counter() - started,
+                    outcome=outcome)
+
+
+def without_hop_by_hop(headers) -> list:
+    return [
+        (k, v) for k, v in headers.items()
+        if k.lower() not in HOP_BY_HOP_HEADERS
+    ]
+
+
+def has_request_body(request: Request) -> bool:
+    return "content-length" in request.headers or \
+        "transfer-encoding" in request.headers
+
+
+def has_form_body(request: Request) -> bool:
+    content_type = request.content_type.split(";")[0].strip().lower()
+
+    return has_request_body(request) and content_type in FORM_CONTENT_TYPES
+
+
+def selected_headers(request: Request, names: list) -> list:
+    return [
+        (name, value)
+        for name in names
+        for value in request.headers.getall(name, [])
+    ]
+
 
 @waf_blueprint.route('/<path:[\w\W\/]*>',
                      methods=[
@@ -20,56 +229,152 @@ waf_blueprint = Blueprint("waf_brain")
                          "DELETE",
                          "HEAD",
                          "OPTIONS"
-                     ])
+                     ],
+                     stream=True)
 async def waf(request: Request, path):
-    MODEL = request.app.config["MODEL"]
+    SCORER = request.app.config["SCORER"]
+    VERDICT_CACHE = request.app.config["VERDICT_CACHE"]
+    UPSTREAM = request.app.config["UPSTREAM"]
     PROTECTED_URL = request.app.config["PROTECTED_URL"]
+    PROXY_CHUNK_SIZE = request.app.config["PROXY_CHUNK_SIZE"]
+    PROXY_MAX_BUFFER = request.app.config["PROXY_MAX_BUFFER"]
     BLOCKING_MODE = request.app.config["BLOCKING_MODE"]
     BLOCKING_THRESHOLD = request.app.config["BLOCKING_THRESHOLD"]
-    TIMEOUT_BACKEND = request.app.config["TIMEOUT_BACKEND"]
+    EARLY_EXIT = request.app.config["EARLY_EXIT"]
+    SCORE_BODY = request.app.config["SCORE_BODY"]
+    SCORE_COOKIES = request.app.config["SCORE_COOKIES"]
+    SCORE_HEADERS = request.app.config["SCORE_HEADERS"]
+    METRICS = request.app.config["METRICS"]
+    DEBUG_SAMPLE_RATE = request.app.config["DEBUG_SAMPLE_RATE"]
 
-    total = []
-    print(request.query_args)
-    
-    for arg, val in request.query_args:
-        total.append(process_payload)(
-        result = process_payload(
-            MODEL,
-            arg,
-            [val],
-            False
-        ))
-        
+    started = time.perf_counter()
+
+    if sample_debug(log, DEBUG_SAMPLE_RATE):
+        log.debug(f"{request.method} /{path} - query args: "
+                  f"{request.query_args}")
+
+    #
+    # Form bodies are buffered to be scored, then they are forwarded as
+    # they are. Others are streamed
+    #
+    body = None
+    form = []
+    if SCORE_BODY and has_form_body(request):
+        body = await read_request_body(request, PROXY_MAX_BUFFER)
+        if body is None:
+            await discard_request_body(request)
+            answered(METRICS, started, "too_large")
+            return response.text("Request body too large to be inspected",
+                                 status=413)
+
+        request.body = body
+        form = [
+            (name, value)
+            for name, values in request.form.items()
+            for value in values
+        ]
+
+    params = request_params(
+        request.query_args,
+        form=form,
+        cookies=request.cookies.items() if SCORE_COOKIES else (),
+        headers=selected_headers(request, SCORE_HEADERS)
+    )
+
+    if BLOCKING_MODE and EARLY_EXIT:
+        total, skipped = await score_until_blocked(SCORER,
+                                                   VERDICT_CACHE,
+                                                   params,
+                                                   BLOCKING_THRESHOLD)
+
+        if skipped:
+            log.info(f"early exit: skipped {len(skipped)} of {len(params)} "
+                     f"params ({sum(len(v) for _, v in skipped)} of "
+                     f"{sum(len(v) for _, v in params)} characters)")
+    else:
+        # All the parameters go to the same batch
+        total = await score_params(SCORER, VERDICT_CACHE, params)
 
     #
     # Request must be block if the WAF detect and attack?
     #
     if BLOCKING_MODE:
-        if any(x["score"] >= BLOCKING_THRESHOLD for x in total):
+        if any(is_dangerous(x, BLOCKING_THRESHOLD) for x in total):
+            if body is None:
+                await discard_request_body(request)
+            answered(METRICS, started, "blocked")
             return response.text("Dangerous request detected and blocked",
                                  status=403)
 
 
     #
-    # Send the original request to the api
+    # Send the original request to the api. The client cookies go in the
+    # forwarded headers, the shared session doesn't keep a cookie jar.
+    #
+    # Request and response bodies are streamed, chunk by chunk
     #
-    async with aiohttp.ClientSession(cookies=request.cookies, read_timeout=TIMEOUT_BACKEND) as session:
+    if body is None and has_request_body(request):
+        body = StreamedBody(request)
+
+    before_time = time.perf_counter()
+    try:
+        resp = await UPSTREAM.request(
+            request.method,
+            f"{PROTECTED_URL.rstrip('/')}/{path}",
+            headers=without_hop_by_hop(request.headers),
+            data=body,
+            params=request.query_args)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.warning(f"can't forward request to {PROTECTED_URL}: {e!r}")
+        if isinstance(body, StreamedBody) and not body.sent:
+            await discard_request_body(request)
+
+        METRICS.inc("errors_total", kind="upstream")
+        answered(METRICS, started, "error")
+        return response.text("Protected application unavailable",
+                             status=502)
+    except Exception:
+        METRICS.inc("errors_total", kind="upstream")
+        answered(METRICS, started, "error")
+        raise
+
+    METRICS.observe("stage_seconds",
+                    time.perf_counter() - before_time,
+                    stage="upstream")
+
+    headers = without_hop_by_hop(resp.headers)
+
+    if request.method == "HEAD" or not has_message_body(resp.status):
+        await release_upstream(request, resp, body)
+        answered(METRICS, started, "forwarded")
+
+        return response.raw(
+            body=b"",
+            status=resp.status,
+            headers=headers,
+            content_type=resp.content_type
+        )
 
-        async with session.request(
-                request.method,
-                PROTECTED_URL + path,
-                headers=request.headers,
-                data=request.body,
-                params=request.query_args) as resp:
+    async def stream_response_body(client_response):
+        before_time = time.perf_counter()
+        try:
+            async for chunk in resp.content.iter_chunked(PROXY_CHUNK_SIZE):
+                await client_response.write(chunk)
+        finally:
+            await release_upstream(request, resp, body)
 
-            body = await resp.content.read()
+            METRICS.observe("stage_seconds",
+                            time.perf_counter() - before_time,
+                            stage="response")
+            answered(METRICS, started, "forwarded")
 
-            return response.raw(
-                body=body,
-                status=resp.status,
-                headers=dict(resp.headers),
-                content_type=resp.content_type
-            )
+    return response.stream(
+        stream_response_body,
+        status=resp.status,
+        headers=headers,
+        content_type=resp.content_type,
+        chunked="Content-Length" not in resp.headers
+    )
 
 
-__all__ = ("waf_blueprint", )
\ No newline at end of file
+__all__ = ("waf_blueprint", "UpstreamResponse")
\ No newline at end of file
@@ -1,15 +1,59 @@
+import time
+import asyncio
 import logging
-import aiofiles
 
 from sanic import response, Blueprint
 
-from waf_brain.inferring import process_payload
+from waf_brain.inferring import (
+    process_payload, request_params, is_dangerous, unscorable_verdict
+)
+from .end_points_waf import answered
 
 log = logging.getLogger("waf-brain")
 
 waf_blueprint_simulator = Blueprint("waf_brain_simulator")
 
 
+async def weigh_param(model,
+                      executor,
+                      cache,
+                      param_name: str,
+                      payload: str,
+                      occlusion: bool):
+    kind = "weights+occlusion" if occlusion else "weights"
+
+    verdict = await cache.get(model.identity, kind, payload) \
+        if cache else None
+
+    if verdict is None:
+        result = await executor.run(process_payload,
+                                    model,
+                                    param_name,
+                                    [payload],
+                                    True,
+                                    occlusion)
+        # It failed, nothing says it's safe
+        if result is None:
+            result = {**unscorable_verdict(param_name), "weights": []}
+
+        if result.get("unscorable"):
+            return result
+
+        verdict = {
+            "score": result["score"],
+            "time": result["time"],
+            "weights": result["weights"]
+        }
+
+        if cache:
+            cache.set(model.identity, kind, payload, verdict)
+
+    return {
+        "paramName": param_name,
+        **verdict
+    }
+
+
 @waf_blueprint_simulator.route('/<path:[\w\W\/]*>',
                                methods=[
                                    "GET",
@@ -21,39 +65,63 @@ waf_blueprint_simulator = Blueprint("waf_brain_simulator")
                                ])
 async def waf_simulator(request, path):
     MODEL = request.app.config["MODEL"]
+    EXECUTOR = request.app.config["EXECUTOR"]
+    VERDICT_CACHE = request.app.config["VERDICT_CACHE"]
     BLOCKING_THRESHOLD = request.app.config["BLOCKING_THRESHOLD"]
-    DUMP_FILE = request.app.config["DUMP_FILE"]
-
-    total = []       
-    for arg, val in request.query_args:
-        total.append(process_payload(
-            MODEL,
-            arg,
-            [val],
-            True
-        ))
-
-    async with aiofiles.open(DUMP_FILE, 'a+') as f:
-
-        await f.writelines(
-            [
-                f"[sec: {t['time']:.5f}] param: '{t['paramName']}' "
-                f"- Scoring: {t['score']} - "
-                f"track-id:"
-                f"{request.headers.get('WAF-BENCHMARK-TRACK-ID')}\n"
-                f"{t['weights']}\n"
-                for t in total
-            ]
-            )
+    DUMP_WRITER = request.app.config["DUMP_WRITER"]
+    WEIGHTS_OCCLUSION = request.app.config["WEIGHTS_OCCLUSION"]
+    SCORE_BODY = request.app.config["SCORE_BODY"]
+    SCORE_COOKIES = request.app.config["SCORE_COOKIES"]
+    SCORE_HEADERS = request.app.config["SCORE_HEADERS"]
+    METRICS = request.app.config["METRICS"]
+
+    started = time.perf_counter()
+
+    params = request_params(
+        request.query_args,
+        form=[
+            (name, value)
+            for name, values in request.form.items()
+            for value in values
+        ] if SCORE_BODY else (),
+        cookies=request.cookies.items() if SCORE_COOKIES else (),
+        headers=[
+            (name, value)
+            for name in SCORE_HEADERS
+            for value in request.headers.getall(name, [])
+        ]
+    )
+
+    total = await asyncio.gather(*[
+        weigh_param(MODEL,
+                    EXECUTOR,
+                    VERDICT_CACHE,
+                    arg,
+                    val,
+                    WEIGHTS_OCCLUSION)
+        for arg, val in params
+    ])
+
+    track_id = request.headers.get('WAF-BENCHMARK-TRACK-ID')
+    for t in total:
+        DUMP_WRITER.write({
+            "time": t["time"],
+            "paramName": t["paramName"],
+            "score": t["score"],
+            "trackId": track_id,
+            "weights": t["weights"]
+        })
 
     #
     # Request must be block if the WAF detect and attack?
     #
-    if any(x["score"] >= BLOCKING_THRESHOLD for x in total):
+    if any(is_dangerous(x, BLOCKING_THRESHOLD) for x in total):
+        answered(METRICS, started, "blocked")
         return response.text("Dangerous request detected and blocked",
                              status=403)
 
     else:
+        answered(METRICS, started, "passed")
         return response.text("OK", status=200)
 
 
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from waf_brain.exceptions import InferenceQueueFull
+
+log = logging.getLogger("waf-brain")
+
+
+class InferenceExecutor:
+    """
+    Run the blocking model calls in a pool of threads, out of the event
+    loop. TensorFlow releases the GIL while it computes, so the threads
+    share the loaded model.
+
+    No more than `max_queue` calls can be waiting or running at the same
+    time, new calls raise InferenceQueueFull.
+    """
+
+    def __init__(self, workers: int = 1, max_queue: int = 1024):
+        self.workers = int(workers)
+        self.max_queue = int(max_queue)
+
+        self._in_flight = 0
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="waf-brain-inference"
+        )
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def run(self, fn, *args, **kwargs):
+        if self._in_flight >= self.max_queue:
+            raise InferenceQueueFull(
+                f"inference queue is full ({self.max_queue} calls)"
+            )
+
+        self._in_flight += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self._pool,
+                partial(fn, *args, **kwargs)
+            )
+        finally:
+            self._in_flight -= 1
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+__all__ = ("InferenceExecutor", )
@@ -0,0 +1,114 @@
+import os
+
+from waf_brain.bundles import load_bundle, read_manifest
+from waf_brain.cache import model_identity
+from waf_brain.engines import KerasEngine, NumPyEngine, bucket_rows
+from .batching import InferenceBatcher
+from .scoring import CascadeScorer, EnsembleScorer
+from .startup import StartupPhases, warmup_sizes, warm_up
+
+
+def model_name(model_path: str) -> str:
+    return os.path.splitext(os.path.basename(model_path))[0]
+
+
+def phase_prefix(config, model_path: str) -> str:
+    # Phases are named by model when there are several
+    if len(config["MODEL_CHAIN"]) == 1:
+        return ""
+
+    return f"{model_name(model_path)}:"
+
+
+def load_engine(config,
+                model_path: str,
+                model_bundle: str,
+                phases: StartupPhases):
+    """Load a model with the engine of the config"""
+    prefix = phase_prefix(config, model_path)
+
+    if config["ENGINE"] == "numpy":
+        with phases.phase(f"{prefix}load"):
+            if model_bundle:
+                return NumPyEngine.from_bundle(model_bundle)
+
+            return NumPyEngine.from_h5(model_path,
+                                       identity=model_identity(model_path))
+
+    # TensorFlow is only imported by the workers that run the model
+    with phases.phase(f"{prefix}import"):
+        from keras.models import load_model
+
+    with phases.phase(f"{prefix}load"):
+        if model_bundle:
+            keras_model = load_bundle(model_bundle)
+            identity = read_manifest(model_bundle)["identity"]
+        else:
+            keras_model = load_model(model_path)
+            identity = model_identity(model_path)
+
+    with phases.phase(f"{prefix}engine"):
+        return KerasEngine(keras_model,
+                           identity=identity,
+                           buckets=config["BUCKETS"])
+
+
+def load_models(config, phases: StartupPhases) -> list:
+    """Engines of all the models of the config"""
+    return [
+        load_engine(config, model_path, model_bundle, phases)
+        for model_path, model_bundle in config["MODEL_CHAIN"]
+    ]
+
+
+def warm_up_models(config, models: list, phases: StartupPhases):
+    sizes = warmup_sizes(config["BATCH_FLUSH_SIZE"])
+
+    # Every bucket up to the flush size is traced before serving
+    if config["ENGINE"] == "keras" and config["BUCKETS"] != "none":
+        sizes = sorted({
+            bucket_rows(size, config["BUCKETS"])
+            for size in range(1, config["BATCH_FLUSH_SIZE"] + 1)
+        })
+
+    for model, (model_path, _) in zip(models, config["MODEL_CHAIN"]):
+        warm_up(model, sizes, phases, phase_prefix(config, model_path))
+
+
+def start_batchers(config, models: list, executor, metrics=None) -> list:
+    """Start a batcher for each model"""
+    batchers = [
+        InferenceBatcher(
+            model,
+            flush_size=config["BATCH_FLUSH_SIZE"],
+            max_wait=config["BATCH_MAX_WAIT"],
+            executor=executor,
+            max_queue=config["INFERENCE_QUEUE"],
+            name=model_name(model_path),
+            metrics=metrics
+        )
+        for model, (model_path, _) in zip(models, config["MODEL_CHAIN"])
+    ]
+
+    for batcher in batchers:
+        batcher.start()
+
+    return batchers
+
+
+def make_scorer(config, batchers: list):
+    """The batcher of the model, or a scorer of all the models"""
+    if config["SCORING"] == "cascade":
+        return CascadeScorer(batchers,
+                             threshold=config["BLOCKING_THRESHOLD"],
+                             band=config["CASCADE_BAND"])
+
+    if config["SCORING"] == "ensemble":
+        return EnsembleScorer(batchers,
+                              threshold=config["BLOCKING_THRESHOLD"])
+
+    return batchers[0]
+
+
+__all__ = ("model_name", "load_models", "warm_up_models", "start_batchers",
+           "make_scorer")
@@ -1,8 +1,145 @@
-from sanic import Sanic
-from keras.models import load_model
-from .end_points_waf import waf_blueprint
+import signal
+import asyncio
+import logging
+
+import aiohttp
+
+from sanic import Sanic, response
+from waf_brain.cache import VerdictCache
+from waf_brain.exceptions import InferenceQueueFull
+from waf_brain.helpers import memory_usage
+from waf_brain.metrics import Metrics
+from .dumping import DumpWriter
+from .executor import InferenceExecutor
+from .inference import (
+    load_models, warm_up_models, start_batchers, make_scorer
+)
+from .reloading import reload_app
+from .startup import StartupPhases
+from .end_points_waf import waf_blueprint, UpstreamResponse
+from .end_points_admin import admin_blueprint, metrics
 from .end_points_waf_simulator import waf_blueprint_simulator
 
+log = logging.getLogger("waf-brain")
+
+
+async def load_engine(app: Sanic, loop):
+    app.config["MODELS"] = load_models(app.config, app.config["STARTUP"])
+    app.config["MODEL"] = app.config["MODELS"][0]
+
+
+async def start_inference(app: Sanic, loop):
+    app.config["RELOAD_LOCK"] = asyncio.Lock()
+
+    with app.config["STARTUP"].phase("inference"):
+        app.config["VERDICT_CACHE"] = VerdictCache(
+            max_size=app.config["CACHE_SIZE"],
+            ttl=app.config["CACHE_TTL"],
+            store=app.config["CACHE_STORE"]
+        ) if app.config["CACHE_SIZE"] > 0 else None
+        app.config["EXECUTOR"] = InferenceExecutor(
+            workers=app.config["INFERENCE_WORKERS"],
+            max_queue=app.config["INFERENCE_QUEUE"]
+        )
+        app.config["BATCHERS"] = start_batchers(app.config,
+                                                app.config["MODELS"],
+                                                app.config["EXECUTOR"],
+                                                app.config["METRICS"])
+        app.config["BATCHER"] = app.config["BATCHERS"][0]
+        app.config["SCORER"] = make_scorer(app.config, app.config["BATCHERS"])
+
+
+async def warm_up_model(app: Sanic):
+    STARTUP = app.config["STARTUP"]
+
+    try:
+        await app.config["EXECUTOR"].run(warm_up_models,
+                                         app.config,
+                                         app.config["MODELS"],
+                                         STARTUP)
+    except Exception:
+        log.exception("can't warm up the model")
+        return
+
+    STARTUP.ready = True
+    log.info(f"ready to serve - startup: {STARTUP.summary()} - "
+             f"memory: {memory_usage()}")
+
+
+async def start_warm_up(app: Sanic, loop):
+    # Requests are served meanwhile, /__health answers when it's done
+    app.config["WARM_UP"] = asyncio.ensure_future(warm_up_model(app))
+
+
+async def reload_on_sighup(app: Sanic, loop):
+    async def reload():
+        log.info("SIGHUP received, reloading")
+        try:
+            await reload_app(app, force=True)
+        except Exception:
+            log.exception("can't reload")
+
+    loop.add_signal_handler(signal.SIGHUP,
+                            lambda: asyncio.ensure_future(reload()))
+
+
+async def stop_inference(app: Sanic, loop):
+    if not app.config["WARM_UP"].done():
+        app.config["WARM_UP"].cancel()
+
+    for batcher in app.config["BATCHERS"]:
+        await batcher.stop()
+    app.config["EXECUTOR"].shutdown()
+
+    if app.config["VERDICT_CACHE"]:
+        app.config["VERDICT_CACHE"].close()
+
+
+async def start_upstream(app: Sanic, loop):
+    app.config["UPSTREAM"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=app.config["UPSTREAM_POOL_SIZE"],
+            limit_per_host=app.config["UPSTREAM_PER_HOST"],
+            keepalive_timeout=app.config["UPSTREAM_KEEPALIVE"],
+            ttl_dns_cache=app.config["UPSTREAM_DNS_TTL"]
+        ),
+        cookie_jar=aiohttp.DummyCookieJar(),
+        response_class=UpstreamResponse,
+        timeout=aiohttp.ClientTimeout(
+            sock_connect=app.config["TIMEOUT_BACKEND"],
+            sock_read=app.config["TIMEOUT_BACKEND"]
+        ),
+        # Bodies are proxied as they are, even if they are compressed
+        auto_decompress=False,
+        read_bufsize=app.config["PROXY_CHUNK_SIZE"]
+    )
+
+
+async def stop_upstream(app: Sanic, loop):
+    await app.config["UPSTREAM"].close()
+
+
+async def start_dump(app: Sanic, loop):
+    app.config["DUMP_WRITER"] = DumpWriter(
+        app.config["DUMP_FILE"],
+        fmt=app.config["DUMP_FORMAT"],
+        max_bytes=app.config["DUMP_MAX_BYTES"],
+        max_queue=app.config["DUMP_QUEUE"]
+    )
+    app.config["DUMP_WRITER"].start()
+
+
+async def stop_dump(app: Sanic, loop):
+    await app.config["DUMP_WRITER"].stop()
+
+
+async def inference_queue_full(request, exception):
+    request.app.config["METRICS"].inc("errors_total", kind="queue_full")
+
+    return response.text("WAF is overloaded, try again later",
+                         status=503,
+                         headers={"Retry-After": "1"})
+
 
 def make_app(config_file: dict) -> Sanic:
     class _fake:
@@ -17,9 +154,31 @@ def make_app(config_file: dict) -> Sanic:
 
     if app.config["ENABLE_TESTING"]:
         app.blueprint(waf_blueprint_simulator)
+
+        app.register_listener(start_dump, "before_server_start")
+        app.register_listener(stop_dump, "after_server_stop")
     else:
         app.blueprint(waf_blueprint)
 
-    app.config["MODEL"] = load_model(config_file["model"])
+        # Bound the request chunks buffered for each connection
+        app.config.REQUEST_BUFFER_QUEUE_SIZE = max(
+            1, app.config["PROXY_MAX_BUFFER"] // app.config["PROXY_CHUNK_SIZE"]
+        )
+        app.register_listener(start_upstream, "before_server_start")
+        app.register_listener(stop_upstream, "after_server_stop")
+    app.blueprint(admin_blueprint)
+    app.add_route(metrics, app.config["METRICS_PATH"], methods=["GET"])
+
+    app.config["STARTUP"] = StartupPhases()
+    app.config["METRICS"] = Metrics()
+    app.config["MODELS"] = []
+    app.config["MODEL"] = None
+
+    app.register_listener(load_engine, "before_server_start")
+    app.register_listener(start_inference, "before_server_start")
+    app.register_listener(start_warm_up, "after_server_start")
+    app.register_listener(reload_on_sighup, "after_server_start")
+    app.register_listener(stop_inference, "after_server_stop")
+    app.error_handler.add(InferenceQueueFull, inference_queue_full)
 
-    return app
\ No newline at end of file
+    return app
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+
+from sanic import Sanic
+
+from waf_brain.data import WAFBrainRunningConfig
+from waf_brain.exceptions import WAFBrainException
+from .inference import (
+    load_models, warm_up_models, start_batchers, make_scorer
+)
+from .startup import StartupPhases
+
+log = logging.getLogger("waf-brain")
+
+# Config arguments that can't change without restarting the server
+RESTART_ARGUMENTS = {
+    "protected_url",
+    "verbosity",
+    "listen_addr",
+    "listen_port",
+    "backlog",
+    "enable_testing",
+    "timeout_backend",
+    "upstream_pool_size",
+    "upstream_per_host",
+    "upstream_keepalive",
+    "upstream_dns_ttl",
+    "proxy_chunk_size",
+    "proxy_max_buffer",
+    "inference_workers",
+    "inference_queue",
+    "cache_size",
+    "cache_ttl",
+    "cache_store",
+    "admin_token",
+    "metrics_path",
+    "dump_file",
+    "dump_format",
+    "dump_max_bytes",
+    "dump_queue",
+}
+
+# When they change, the models are loaded again
+MODEL_FIELDS = ("MODEL_CHAIN", "ENGINE", "BUCKETS")
+
+
+async def reload_app(app: Sanic, changes: dict = None, force: bool = False):
+    """
+    Reload the config of the app with some arguments changed. The models
+    are loaded again if they change or if `force`.
+
+    New models are loaded and warmed up in the background, then everything
+    is swapped at once. Requests that already took the old models finish
+    with them.
+    """
+    changes = changes or {}
+    arguments = app.config["ARGUMENTS"]
+
+    unknown = set(changes) - set(arguments)
+    if unknown:
+        raise WAFBrainException(
+            f"Unknown config fields: {', '.join(sorted(unknown))}"
+        )
+
+    changed = sorted(k for k, v in changes.items() if v != arguments[k])
+
+    restart = RESTART_ARGUMENTS.intersection(changed)
+    if restart:
+        raise WAFBrainException(
+            f"Changing {', '.join(sorted(restart))} needs a restart"
+        )
+
+    async with app.config["RELOAD_LOCK"]:
+        try:
+            running_config = WAFBrainRunningConfig(
+                **{**app.config["ARGUMENTS"], **changes}
+            )
+        except (TypeError, ValueError, AttributeError) as e:
+            raise WAFBrainException(f"Invalid config: {e}")
+
+        config = {k.upper(): v for k, v in running_config.to_dict.items()}
+
+        phases = StartupPhases()
+        loop = asyncio.get_event_loop()
+
+        reload_models = force or any(
+            config[field] != app.config[field] for field in MODEL_FIELDS
+        )
+        if reload_models:
+            # Out of the inference executor, that keeps serving meanwhile
+            models = await loop.run_in_executor(
+                None, load_models, config, phases
+            )
+            await loop.run_in_executor(
+                None, warm_up_models, config, models, phases
+            )
+        else:
+            models = app.config["MODELS"]
+
+        batchers = start_batchers(config,
+                                  models,
+                                  app.config["EXECUTOR"],
+                                  app.config["METRICS"])
+        old_batchers = app.config["BATCHERS"]
+
+        # Swapped at once, no request sees a half reloaded app
+        app.config.update(config)
+        app.config.update({
+            "MODELS": models,
+            "MODEL": models[0],
+            "BATCHERS": batchers,
+            "BATCHER": batchers[0],
+            "SCORER": make_scorer(config, batchers),
+        })
+
+    for batcher in old_batchers:
+        await batcher.stop()
+
+    log.info(f"reloaded - changed: {changed}" +
+             (f" - models reloaded ({phases.summary()})"
+              if reload_models else ""))
+
+    return {
+        "changed": changed,
+        "models_reloaded": reload_models,
+        "models": [b.name for b in batchers],
+        "phases": phases.phases
+    }
+
+
+__all__ = ("reload_app", )
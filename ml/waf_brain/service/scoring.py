@@ -0,0 +1,154 @@
+import time
+import asyncio
+
+from collections import deque
+
+import numpy as np
+
+
+class CascadeScorer:
+    """
+    Score the payloads with a chain of models, from the cheapest to the
+    most expensive one.
+
+    Every payload is scored by the first model. Only the payloads whose
+    score is in the uncertainty band, closer than `band` to the threshold,
+    are escalated to the next model, whose score replaces the previous one.
+
+    `batchers` are the InferenceBatcher of each model of the chain.
+
+    The model time saved is estimated from the windows scored by each model
+    and the mean time per window each one has needed so far.
+    """
+
+    def __init__(self,
+                 batchers: list,
+                 threshold: float,
+                 band: float,
+                 history: int = 10000):
+        self.batchers = batchers
+        self.threshold = float(threshold)
+        self.band = float(band)
+        self.identity = "cascade:" + "|".join(
+            b.identity for b in batchers
+        ) + f":{self.threshold}:{self.band}"
+
+        self.payloads = 0
+        self.escalated = [0] * (len(batchers) - 1)
+        self.windows = [0] * len(batchers)
+        self.latencies = deque(maxlen=history)
+
+    def uncertain(self, score: float) -> bool:
+        return abs(score - self.threshold) < self.band
+
+    async def score_many(self, payloads: list, strict: bool = False) -> list:
+        """Same as InferenceBatcher.score_many, escalating uncertain scores"""
+        before_time = time.perf_counter()
+
+        scores = await self.batchers[0].score_many(payloads, strict)
+        self.windows[0] += sum(len(p) for p in payloads)
+
+        pending = [
+            i for i, score in enumerate(scores)
+            if score is not None and self.uncertain(score)
+        ]
+
+        for stage, batcher in enumerate(self.batchers[1:]):
+            if not pending:
+                break
+
+            self.escalated[stage] += len(pending)
+            self.windows[stage + 1] += sum(len(payloads[i]) for i in pending)
+
+            escalated = await batcher.score_many(
+                [payloads[i] for i in pending], strict
+            )
+            for i, score in zip(pending, escalated):
+                scores[i] = score
+
+            pending = [
+                i for i in pending
+                if scores[i] is not None and self.uncertain(scores[i])
+            ]
+
+        elapsed = time.perf_counter() - before_time
+        self.payloads += len(payloads)
+        self.latencies.extend([elapsed] * len(payloads))
+
+        return scores
+
+    @property
+    def stats(self) -> dict:
+        costs = [b.seconds_per_window for b in self.batchers]
+
+        model_ms = last_model_ms = None
+        if None not in costs:
+            model_ms = sum(w * c for w, c in zip(self.windows, costs)) * 1000
+            last_model_ms = self.windows[0] * costs[-1] * 1000
+
+        return {
+            "mode": "cascade",
+            "models": [b.name for b in self.batchers],
+            "band": self.band,
+            "payloads": self.payloads,
+            "escalated": self.escalated,
+            "escalation_rate": self.escalated[0] / self.payloads
+            if self.payloads else 0.0,
+            "latency_ms_mean": float(np.mean(self.latencies)) * 1000
+            if self.latencies else 0.0,
+            "windows": self.windows,
+            "model_ms": model_ms,
+            "last_model_only_ms": last_model_ms,
+            "model_ms_saved": last_model_ms - model_ms
+            if model_ms is not None else None,
+        }
+
+
+class EnsembleScorer:
+    """
+    Score each payload with several models, in the same batching tick, and
+    average their scores.
+    """
+
+    def __init__(self, batchers: list, threshold: float):
+        self.batchers = batchers
+        self.threshold = float(threshold)
+        self.identity = "ensemble:" + "|".join(b.identity for b in batchers)
+
+        self.payloads = 0
+        self.disagreements = 0
+
+    async def score_many(self, payloads: list, strict: bool = False) -> list:
+        """Same as InferenceBatcher.score_many, averaging the models"""
+        results = await asyncio.gather(*[
+            batcher.score_many(payloads, strict) for batcher in self.batchers
+        ])
+
+        scores = []
+        for model_scores in zip(*results):
+            if None in model_scores:
+                scores.append(None)
+                continue
+
+            verdicts = {score >= self.threshold for score in model_scores}
+            self.disagreements += len(verdicts) > 1
+
+            scores.append(float(np.mean(model_scores)))
+
+        self.payloads += len(payloads)
+
+        return scores
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "mode": "ensemble",
+            "models": [b.name for b in self.batchers],
+            "payloads": self.payloads,
+            "disagreements": self.disagreements,
+            "disagreement_rate": self.disagreements / self.payloads
+            if self.payloads else 0.0,
+        }
+
+
+__all__ = ("CascadeScorer", "EnsembleScorer")
@@ -0,0 +1,71 @@
+import time
+import logging
+
+from itertools import cycle, islice
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from waf_brain.inferring import (
+    VOCABULARY, encode_payload, window_indices, model_features
+)
+
+log = logging.getLogger("waf-brain")
+
+
+class StartupPhases:
+    """
+    Time spent in each phase of the startup of a worker. The worker is
+    ready once the model has been warmed up.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.ready = False
+
+    @contextmanager
+    def phase(self, name: str):
+        before_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - before_time
+
+    @property
+    def total(self) -> float:
+        return sum(self.phases.values())
+
+    def summary(self) -> str:
+        return ", ".join(
+            f"{name} {seconds:.3f}s" for name, seconds in self.phases.items()
+        ) + f" - total {self.total:.3f}s"
+
+
+def warmup_sizes(flush_size: int) -> list:
+    """Batch sizes, in windows, the model is warmed up with"""
+    sizes = {1, int(flush_size)}
+
+    size = 8
+    while size < flush_size:
+        sizes.add(size)
+        size *= 8
+
+    return sorted(sizes)
+
+
+def warm_up(model, sizes: list, phases: StartupPhases, prefix: str = ""):
+    """
+    Run the model over synthetic payloads of each batch size, so the first
+    requests don't pay for tracing the graph and initializing its kernels.
+    """
+    x_features = model_features(model)
+    letters = cycle(VOCABULARY)
+
+    for size in sizes:
+        payload = "".join(islice(letters, size))
+        windows, _ = window_indices(encode_payload(payload), x_features)
+
+        with phases.phase(f"{prefix}warmup_{size}"):
+            model.predict_logits(windows)
+
+
+__all__ = ("StartupPhases", "warmup_sizes", "warm_up")
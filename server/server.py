@@ -1,16 +1,23 @@
-from flask import Flask, request, jsonify
-import requests
+from aiohttp import web
+import aiohttp
+import asyncio
 import csv
 from datetime import datetime
 import os
-
-app = Flask(__name__)
+import time
 
 # WAF URL
-WAF_URL = 'http://waf/'  # Adjust if necessary
+WAF_URL = os.environ.get('WAF_URL', 'http://waf/')
 
 # ML Service URL (Assuming it runs on port 8000 in the same network)
-ML_URL = 'http://ml:8000/'  # Adjust if necessary
+ML_URL = os.environ.get('ML_URL', 'http://ml:8000/')
+
+# Seconds each backend has to answer
+WAF_TIMEOUT = float(os.environ.get('WAF_TIMEOUT', 10))
+ML_TIMEOUT = float(os.environ.get('ML_TIMEOUT', 10))
+
+# Keep-alive connections kept open to each backend
+POOL_SIZE = int(os.environ.get('POOL_SIZE', 100))
 
 # Ensure the logs directory exists
 LOG_DIRECTORY = 'logs'
@@ -35,48 +42,75 @@ if not os.path.isfile(LOG_FILE_PATH):
         writer.writerow(header)
     print(f"Initialized log file with headers at {LOG_FILE_PATH}")
 
+
+def backend_session(timeout):
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=POOL_SIZE),
+        timeout=aiohttp.ClientTimeout(total=timeout)
+    )
+
+
+def request_error(e, timeout):
+    if isinstance(e, asyncio.TimeoutError):
+        return f"Timed out after {timeout}s"
+    return str(e)
+
+# Await a backend request, also returning how long it took in milliseconds
+async def timed(coroutine):
+    started = time.perf_counter()
+    result = await coroutine
+    return result, round((time.perf_counter() - started) * 1000, 3)
+
 # Function to send request to WAF
-def send_request_to_waf(payload):
+async def send_request_to_waf(session, payload):
     try:
         url = WAF_URL
         params = {
             'exec': payload
         }
-        response = requests.get(url, params=params)
-        waf_timestamp = datetime.now().isoformat()
-        return response.status_code, response.text, waf_timestamp
-    except requests.exceptions.RequestException as e:
+        async with session.get(url, params=params) as response:
+            await response.read()
+            waf_timestamp = datetime.now().isoformat()
+            return response.status, waf_timestamp
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         waf_timestamp = datetime.now().isoformat()
-        return 'Error', str(e), waf_timestamp
+        print(f"WAF request failed: {request_error(e, WAF_TIMEOUT)}")
+        return 'Error', waf_timestamp
 
 # Function to send request to ML Service
-def send_request_to_ml(payload):
+async def send_request_to_ml(session, payload):
     try:
         url = ML_URL
         params = {
             'q': payload
         }
-        response = requests.get(url, params=params)
+        async with session.get(url, params=params) as response:
+            await response.read()
+            ml_timestamp = datetime.now().isoformat()
+            if response.status == 200:
+                return 200, 'Accepted', ml_timestamp
+            else:
+                return 403, 'Rejected', ml_timestamp
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         ml_timestamp = datetime.now().isoformat()
-        if response.status_code == 200:
-            return 200, 'Accepted', ml_timestamp
-        else:
-            return 403, 'Rejected', ml_timestamp
-    except requests.exceptions.RequestException as e:
-        ml_timestamp = datetime.now().isoformat()
-        return 'Error', str(e), ml_timestamp
+        return 'Error', request_error(e, ML_TIMEOUT), ml_timestamp
 
 # Route to receive requests from client
-@app.route('/request', methods=['POST'])
-def handle_request():
-    payload = request.json.get('payload', '').strip()
+async def handle_request(request):
+    try:
+        payload = (await request.json()).get('payload', '').strip()
+    except (ValueError, AttributeError):
+        return web.json_response({'error': 'Expected a JSON object'},
+                                 status=400)
     overall_timestamp = datetime.now().isoformat()
 
-    # Send request to WAF
-    waf_status_code, waf_response_body, waf_timestamp = send_request_to_waf(payload)
-
-    # Send request to ML Service
-    ml_status_code, ml_prediction, ml_timestamp = send_request_to_ml(payload)
+    # Send the request to the WAF and the ML Service at the same time
+    ((waf_status_code, waf_timestamp), waf_latency_ms), \
+        ((ml_status_code, ml_prediction, ml_timestamp), ml_latency_ms) = \
+        await asyncio.gather(
+            timed(send_request_to_waf(request.app['waf_session'], payload)),
+            timed(send_request_to_ml(request.app['ml_session'], payload))
+        )
 
     # Log to server-side CSV file
     log_entry = [
@@ -88,21 +122,77 @@ def handle_request():
         ml_prediction
     ]
 
-    try:
-        with open(LOG_FILE_PATH, mode='a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(log_entry)
-        print(f"Logged request for payload: {payload}")
-    except Exception as e:
-        print(f"Failed to save log entry: {e}")
+    request.app['log_queue'].put_nowait(log_entry)
 
     # Return response to client
-    return jsonify({
+    return web.json_response({
         'payload': payload,
         'WAF_status_code': waf_status_code,
-        'ML_status_code': ml_status_code
+        'ML_status_code': ml_status_code,
+        'WAF_latency_ms': waf_latency_ms,
+        'ML_latency_ms': ml_latency_ms
     })
 
+
+# Function to append log entries to the CSV file, run in a thread
+def write_log_entries(entries):
+    with open(LOG_FILE_PATH, mode='a', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerows(entries)
+
+# Background task writing the log entries queued by the requests, all the
+# waiting ones at a time, so the requests don't wait for the file. A None
+# entry stops it once the entries before it are written
+async def log_writer(queue):
+    loop = asyncio.get_running_loop()
+    stopped = False
+    while not stopped:
+        entries = [await queue.get()]
+        while not queue.empty():
+            entries.append(queue.get_nowait())
+        if None in entries:
+            entries = entries[:entries.index(None)]
+            stopped = True
+        if not entries:
+            continue
+
+        try:
+            await loop.run_in_executor(None, write_log_entries, entries)
+            for entry in entries:
+                print(f"Logged request for payload: {entry[1]}")
+        except Exception as e:
+            print(f"Failed to save {len(entries)} log entries: {e}")
+
+
+async def start_log_writer(app):
+    app['log_queue'] = asyncio.Queue()
+    app['log_writer'] = asyncio.ensure_future(log_writer(app['log_queue']))
+
+
+async def stop_log_writer(app):
+    app['log_queue'].put_nowait(None)
+    await app['log_writer']
+
+
+async def open_sessions(app):
+    app['waf_session'] = backend_session(WAF_TIMEOUT)
+    app['ml_session'] = backend_session(ML_TIMEOUT)
+
+
+async def close_sessions(app):
+    await app['waf_session'].close()
+    await app['ml_session'].close()
+
+
+def make_app():
+    app = web.Application()
+    app.router.add_post('/request', handle_request)
+    app.on_startup.append(open_sessions)
+    app.on_startup.append(start_log_writer)
+    app.on_cleanup.append(close_sessions)
+    app.on_cleanup.append(stop_log_writer)
+    return app
+
 if __name__ == '__main__':
     # Ensure the server is accessible from other containers by setting host to '0.0.0.0'
-    app.run(host='0.0.0.0', port=5000)
+    web.run_app(make_app(), host='0.0.0.0', port=5000)